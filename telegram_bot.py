@@ -1,31 +1,342 @@
 # telegram_bot.py — Мультиаккаунт + экспорт участников группы + мгновенная работа с любыми ID
 import os
+import sys
+import fcntl
+import gzip
+import json
+import hashlib
+import time
+import uuid
+import queue
+import logging
+import asyncio
+import threading
+import traceback
+import tracemalloc
 import requests
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from urllib.parse import quote
 from telethon.tl import functions, types
-from telethon.errors import PeerIdInvalidError, UserIdInvalidError
+from telethon.errors import PeerIdInvalidError, UserIdInvalidError, RPCError, ChannelPrivateError, ChannelInvalidError
 from telethon.tl.types import InputMediaContact
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, utils
 from telethon.sessions import StringSession
 from telethon.tl.types import PeerUser, PeerChannel, PeerChat
+from telethon.tl.custom import Dialog
 from telethon.tl.functions.messages import GetDialogsRequest, GetDialogFiltersRequest
-from telethon.tl.functions.contacts import ImportContactsRequest, DeleteContactsRequest
+from telethon.tl.functions.contacts import ImportContactsRequest, DeleteContactsRequest, GetContactsRequest
 from telethon.tl.types import InputPhoneContact
 from telethon.errors import SessionPasswordNeededError, FloodWaitError, PhoneNumberInvalidError, UserPrivacyRestrictedError
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, validator
-from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, Response, FileResponse, JSONResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, ValidationError, validator
+from contextlib import asynccontextmanager, AsyncExitStack
 from typing import List, Optional, Union, Dict
 import uvicorn
-from datetime import datetime
+from datetime import datetime, timezone
+
+try:
+    import msgpack  # Необязательно: нужен только для /rpc/ws
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard  # Необязательно: сжатие архивов zstd
+except ImportError:
+    zstandard = None
 
 API_ID = 34135660
 API_HASH = "c3cab94748a3618de8293a4a4f9cd571"
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 10000))  # Вебхуков в очереди; при переполнении сообщение не отправляется
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 1))  # Больше 1 — быстрее, но без гарантии порядка
+
+# Передача работы новому процессу при деплое
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE", "")  # Например "accounts.json": сессии для восстановления при старте; пусто — не сохранять
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 30))  # Секунд на завершение запросов и очереди вебхуков
+JOB_LOCK_RETRY_SECONDS = float(os.getenv("JOB_LOCK_RETRY_SECONDS", 5))  # Пауза, пока задание выполняет другой процесс
+
+# Поток событий (SSE / WebSocket)
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", 1000))  # Кольцевой буфер для Last-Event-ID
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 256))  # Очередь одного подписчика
+EVENT_HEARTBEAT_SECONDS = float(os.getenv("EVENT_HEARTBEAT_SECONDS", 15))
+
+# Обогащение payload входящих: поля через запятую, например "sender_name,sender_username,chat_title"
+WEBHOOK_ENRICH_FIELDS = {f.strip() for f in os.getenv("WEBHOOK_ENRICH_FIELDS", "").split(",") if f.strip()}
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", 10000))  # Записей на аккаунт
+
+# Догон пропущенных обновлений после рестарта (разрывы соединения догоняет сам Telethon)
+CATCH_UP_ENABLED = os.getenv("CATCH_UP_ENABLED", "1") == "1"
+UPDATE_STATE_FILE = os.getenv("UPDATE_STATE_FILE", "update_state.json")
+UPDATE_STATE_SAVE_INTERVAL = float(os.getenv("UPDATE_STATE_SAVE_INTERVAL", 30))  # Секунд между снимками pts/qts
+CATCH_UP_RATE = float(os.getenv("CATCH_UP_RATE", 20))  # Сообщений в секунду при догоне
+CATCH_UP_CHANNEL_LIMIT = int(os.getenv("CATCH_UP_CHANNEL_LIMIT", 500))  # Максимум сообщений на канал
+RECENT_DELIVERIES_SIZE = int(os.getenv("RECENT_DELIVERIES_SIZE", 5000))  # Защита от повторной доставки
+if CATCH_UP_RATE <= 0:
+    raise ValueError(f"CATCH_UP_RATE должен быть больше 0, получено {CATCH_UP_RATE}")
+
+# Дедупликация сообщений групп/каналов, которые видят несколько наших аккаунтов
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "0") == "1"
+DEDUP_WINDOW_SECONDS = float(os.getenv("DEDUP_WINDOW_SECONDS", 600))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", 100000))
+
+# Пул потоков для тяжёлых преобразований и контроль задержек event loop
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", 2))
+CPU_CHUNK_SIZE = int(os.getenv("CPU_CHUNK_SIZE", 1000))  # Элементов на одну передачу в пул
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", 0.5))
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", 0.1))  # Секунд задержки, считающейся зависанием
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))  # Предел длительности /debug/profile
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv("PROFILE_TRACEMALLOC_FRAMES", 10))  # Глубина стека аллокаций
+PROFILE_MEMORY_TOP = int(os.getenv("PROFILE_MEMORY_TOP", 30))  # Мест аллокаций в ответе
+
+# Фоновые задания (/jobs)
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")
+JOBS_PER_ACCOUNT = int(os.getenv("JOBS_PER_ACCOUNT", 1))  # Одновременных заданий на аккаунт
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", 500))  # Записей между контрольными точками
+
+# Архивы истории чатов (/archive): сжатый NDJSON сегментами
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_SEGMENT_BYTES = int(os.getenv("ARCHIVE_SEGMENT_BYTES", 64 * 1024 * 1024))  # Размер, после которого начинается новый сегмент
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "gzip")  # gzip или zstd (нужен пакет zstandard)
+
+# Условные запросы (ETag): закэшированный ответ живёт, пока не изменилась версия, но не дольше TTL
+CONDITIONAL_CACHE_TTL = float(os.getenv("CONDITIONAL_CACHE_TTL", 300))
+
+# Сводные запросы по всем аккаунтам (/all/...)
+AGGREGATE_CONCURRENCY = int(os.getenv("AGGREGATE_CONCURRENCY", 8))  # Аккаунтов одновременно
+AGGREGATE_TIMEOUT = float(os.getenv("AGGREGATE_TIMEOUT", 10))  # Секунд на один аккаунт
+
+# Контроль нагрузки: лимиты одновременных запросов и короткая очередь ожидания
+ACCOUNT_CONCURRENCY = int(os.getenv("ACCOUNT_CONCURRENCY", 16))  # Запросов на аккаунт одновременно
+ROUTE_CONCURRENCY = os.getenv("ROUTE_CONCURRENCY", "export_members=2,chat_history=8,chat_history_batch=4,get_sender_info_batch=4,dialogs_stream=2,media_download=4")  # На аккаунт и маршрут
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", 8))  # Ожидающих сверх лимита, остальные сразу отклоняются
+ADMISSION_WAIT_TIMEOUT = float(os.getenv("ADMISSION_WAIT_TIMEOUT", 2))  # Секунд ожидания места в очереди
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 1))  # Значение заголовка Retry-After
+
+# Бинарный RPC (msgpack поверх WebSocket)
+RPC_MAX_IN_FLIGHT = int(os.getenv("RPC_MAX_IN_FLIGHT", 64))  # Незавершённых запросов на соединение
+
+# /get_sender_info_batch
+SENDER_BATCH_MAX_MESSAGES = int(os.getenv("SENDER_BATCH_MAX_MESSAGES", 1000))  # Сообщений в одном запросе
+SENDER_BATCH_MAX_CHATS = int(os.getenv("SENDER_BATCH_MAX_CHATS", 100))  # Разных чатов в одном запросе
+SENDER_BATCH_CONCURRENCY = int(os.getenv("SENDER_BATCH_CONCURRENCY", 4))  # Чатов одновременно в одном запросе
+
+# /chat_history_batch
+HISTORY_BATCH_MAX_CHATS = int(os.getenv("HISTORY_BATCH_MAX_CHATS", 200))  # Чатов в одном запросе
+HISTORY_BATCH_CONCURRENCY = int(os.getenv("HISTORY_BATCH_CONCURRENCY", 4))  # Чатов одновременно в одном запросе
+
+# Удерживаемые соединения с другими DC для загрузки медиа
+DC_POOL_MAX_PER_ACCOUNT = int(os.getenv("DC_POOL_MAX_PER_ACCOUNT", 3))  # DC на аккаунт
+DC_POOL_MIN_USES = int(os.getenv("DC_POOL_MIN_USES", 2))  # Обращений к DC, после которых соединение удерживается
+DC_POOL_IDLE_SECONDS = float(os.getenv("DC_POOL_IDLE_SECONDS", 300))  # Простой, после которого соединение отпускается
+DC_POOL_SWEEP_INTERVAL = float(os.getenv("DC_POOL_SWEEP_INTERVAL", 30))
+
+# Превью последнего сообщения в списках диалогов (include_preview)
+PREVIEW_TEXT_LENGTH = int(os.getenv("PREVIEW_TEXT_LENGTH", 100))  # Символов текста
+
+# Журнал изменений диалогов для /dialogs/changes
+DIALOG_CHANGE_LOG_SIZE = int(os.getenv("DIALOG_CHANGE_LOG_SIZE", 5000))  # Записей на аккаунт
+
+# Индекс контактов: сверка с Telegram при промахе не чаще раза в N секунд на аккаунт
+CONTACTS_RELOAD_INTERVAL = float(os.getenv("CONTACTS_RELOAD_INTERVAL", 30))
+
+# Структурированное логирование
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")  # Уровни по категориям: "incoming=WARNING,contacts=DEBUG"
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "incoming=20,webhook=5")  # Записей в секунду по категориям
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
 
 # Хранилище: имя → клиент
 ACTIVE_CLIENTS = {}
 # Изменяем формат: добавляем флаг needs_2fa
 PENDING_AUTH = {}  # Формат: {phone: {"session_str": "...", "phone_code_hash": "...", "needs_2fa": False}}
+# Индекс контактов: имя аккаунта → {user_id: {"phone": ..., "first_name": ..., "last_name": ..., "username": ...}}
+CONTACTS_INDEX: Dict[str, Dict[int, dict]] = {}
+CONTACTS_INDEX_LOCKS: Dict[str, asyncio.Lock] = {}
+CONTACTS_INDEX_HASHES: Dict[str, int] = {}  # Хэш списка контактов для GetContactsRequest
+CONTACTS_INDEX_LOADED_AT: Dict[str, float] = {}  # time.monotonic() последней сверки с Telegram
+# Состояние обновлений: имя аккаунта → {"pts", "qts", "date", "seq", "channels": {chat_id: last message id}}
+UPDATE_STATES: Dict[str, dict] = {}
+# Недавно доставленные (chat_id, message_id) по аккаунтам: (set, deque) для O(1) проверки
+RECENT_DELIVERIES: Dict[str, tuple] = {}
+CATCH_UP_TASKS: Dict[str, asyncio.Task] = {}
+# (chat_id, message_id) → {"first_seen": monotonic, "delivered_by": имя, "seen_by": [имена]}; порядок = время
+DEDUP_SEEN: "OrderedDict[tuple, dict]" = OrderedDict()
+DEDUP_STATS = {"delivered": 0, "suppressed": 0}
+# Версии данных аккаунта для ETag: имя → {"dialogs": n, "folders": n}
+ACCOUNT_VERSIONS: Dict[str, Dict[str, int]] = {}
+ACCOUNTS_LIST_VERSION = 0
+# (аккаунт, маршрут, параметры) → {"version", "etag", "body", "fetched_at"}
+RESPONSE_CACHE: Dict[tuple, dict] = {}
+# Журнал изменений диалогов: имя → {"epoch", "seq", "floor", "log": deque[(seq, marked peer id)]}
+DIALOG_CHANGES: Dict[str, dict] = {}
+# Single-flight: ключ вызова → задача, общая для всех одновременных ожидающих
+SINGLE_FLIGHT: Dict[tuple, asyncio.Future] = {}
+SINGLE_FLIGHT_STATS: Dict[str, Dict[str, int]] = {}  # вид вызова → {"calls", "executions"}
+# Контроль нагрузки: (аккаунт, маршрут или None для аккаунта целиком) → AdmissionGate
+ADMISSION_GATES: Dict[tuple, "AdmissionGate"] = {}
+# Последние сообщения диалогов из GetDialogs: имя аккаунта → {marked peer id: Message}
+TOP_MESSAGES: Dict[str, Dict[int, object]] = {}
+# Завершение работы: draining — доделываем начатое; handover — работу уже принял новый процесс
+DRAIN_STATE = {"ready": False, "draining": False, "handover": False, "since": None, "in_flight": 0}
+WEBHOOK_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+WEBHOOK_STATS = {"sent": 0, "failed": 0, "dropped": 0, "in_progress": 0}
+# Соединения с другими DC: имя аккаунта → {dc_id: обращения} и {dc_id: {"sender", "last_used", ...}}
+DC_USAGE: Dict[str, Dict[int, int]] = {}
+DC_POOL: Dict[str, Dict[int, dict]] = {}
+DC_POOL_STATS = {"home": 0, "hits": 0, "misses": 0, "warmed": 0, "evicted": 0, "warm_errors": 0}
+DC_WARM_TASKS: set = set()  # Ссылки на фоновые подключения, чтобы их не собрал сборщик мусора
+# Кэш метаданных сущностей: имя аккаунта → {marked peer id: {"name", "username", "phone", "type"}}
+ENTITY_CACHE: Dict[str, Dict[int, dict]] = {}
+
+
+# ==================== Логирование ====================
+# Контекст текущего HTTP-запроса для записей лога
+LOG_CONTEXT: ContextVar[dict] = ContextVar("log_context", default={})
+# Стандартные атрибуты LogRecord: всё остальное в записи — поля из extra
+_LOG_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+def parse_log_settings(value: str) -> Dict[str, str]:
+    return dict(item.split("=", 1) for item in value.split(",") if "=" in item)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON: время, уровень, категория, контекст запроса и поля extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "category": record.name.removeprefix("gateway."),
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogContextFilter(logging.Filter):
+    """
+    Выполняется в потоке, который вызывает логгер (до постановки в очередь),
+    поэтому LOG_CONTEXT текущего запроса здесь ещё доступен: копирует контекст
+    в запись и прореживает частые категории (не больше N записей в секунду).
+    """
+
+    def __init__(self, sample_rates: Dict[str, float]):
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.windows: Dict[str, list] = {}  # категория → [начало секунды, записано, пропущено]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = record.name.removeprefix("gateway.")
+        rate = self.sample_rates.get(category)
+        if rate is not None and record.levelno < logging.WARNING:
+            window = self.windows.setdefault(category, [0.0, 0, 0])
+            now = time.monotonic()
+            if now - window[0] >= 1:
+                if window[2]:
+                    record.sampled_out = window[2]
+                window[:] = [now, 0, 0]
+            if window[1] >= rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+
+        for key, value in LOG_CONTEXT.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Не блокирует event loop: при переполненной очереди запись отбрасывается"""
+
+    def __init__(self, log_queue: queue.Queue, listener: QueueListener):
+        super().__init__(log_queue)
+        self.listener = listener
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Форматирование в JSON делает фоновый поток; здесь только фиксируем сообщение
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def gateway_log_handler() -> Optional[DroppingQueueHandler]:
+    # Проверяем по атрибуту, а не isinstance: при повторном импорте модуля класс уже другой
+    for handler in logging.getLogger("gateway").handlers:
+        if getattr(handler, "listener", None) is not None:
+            return handler
+    return None
+
+
+def setup_logging() -> QueueListener:
+    """
+    Настроить логгер "gateway" один раз на процесс. При запуске через
+    `python telegram_bot.py` модуль импортируется второй раз (uvicorn.run("telegram_bot:app")) —
+    тогда возвращается уже запущенный слушатель, иначе каждая запись писалась бы дважды.
+    """
+    existing = gateway_log_handler()
+    if existing is not None:
+        return existing.listener
+
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonLogFormatter())
+    listener = QueueListener(log_queue, stream_handler)
+
+    handler = DroppingQueueHandler(log_queue, listener)
+    handler.addFilter(LogContextFilter({k: float(v) for k, v in parse_log_settings(LOG_SAMPLE_RATES).items()}))
+
+    root = logging.getLogger("gateway")
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(handler)
+    root.propagate = False
+    for category, level in parse_log_settings(LOG_LEVELS).items():
+        logging.getLogger(f"gateway.{category}").setLevel(level)
+
+    listener.start()
+    return listener
+
+
+LOG_LISTENER = setup_logging()
+log_app = logging.getLogger("gateway.app")
+log_accounts = logging.getLogger("gateway.accounts")
+log_contacts = logging.getLogger("gateway.contacts")
+log_sender = logging.getLogger("gateway.sender")
+log_send = logging.getLogger("gateway.send")
+log_dialogs = logging.getLogger("gateway.dialogs")
+log_export = logging.getLogger("gateway.export")
+log_updates = logging.getLogger("gateway.updates")
+log_incoming = logging.getLogger("gateway.incoming")
+log_webhook = logging.getLogger("gateway.webhook")
+log_jobs = logging.getLogger("gateway.jobs")
+log_loop = logging.getLogger("gateway.loop")
+log_admission = logging.getLogger("gateway.admission")
+log_rpc = logging.getLogger("gateway.rpc")
+log_media = logging.getLogger("gateway.media")
 
 
 # ==================== Модели ====================
@@ -57,8 +368,16 @@ class Auth2FAReq(BaseModel):
 class ExportMembersReq(BaseModel):
     account: str
     group: str | int
+    format: str = "objects"  # "objects" — список словарей, "columnar" — заголовок + строки
 
 # ==================== Новые модели ====================
+class MessagePreview(BaseModel):
+    id: int
+    text: str = ""  # Первые PREVIEW_TEXT_LENGTH символов
+    sender_id: Optional[int] = None
+    is_outgoing: bool = False
+    media_type: Optional[str] = None  # "photo", "voice", "sticker", ... или None
+
 class DialogInfo(BaseModel):
     id: int
     title: str
@@ -69,11 +388,13 @@ class DialogInfo(BaseModel):
     is_user: bool
     unread_count: int
     last_message_date: Optional[str] = None
+    last_message: Optional[MessagePreview] = None  # Только при include_preview
 
 class GetDialogsReq(BaseModel):
     account: str
     limit: int = 50
     include_folders: bool = True
+    include_preview: bool = False
 
 class ChatMessage(BaseModel):
     id: int
@@ -100,6 +421,11 @@ class GetChatHistoryReq(BaseModel):
     limit: int = 50
     offset_id: Optional[int] = None
 
+class GetChatHistoryBatchReq(BaseModel):
+    account: str
+    chat_ids: List[Union[str, int]]
+    limit: int = 1  # Сообщений на чат
+
 # ==================== НОВАЯ МОДЕЛЬ: отправка новым пользователям ====================
 class SendToNewUserReq(BaseModel):
     account: str
@@ -132,6 +458,140 @@ class GetSenderInfoReq(BaseModel):
     chat_id: Union[str, int]
     message_id: int
 
+class SenderLookupItem(BaseModel):
+    chat_id: Union[str, int]
+    message_id: int
+
+class GetSenderInfoBatchReq(BaseModel):
+    account: str
+    chat_id: Optional[Union[str, int]] = None  # Чат по умолчанию для message_ids
+    message_ids: List[int] = []
+    items: List[SenderLookupItem] = []  # Пары (chat_id, message_id) для нескольких чатов
+
+# ==================== НОВАЯ МОДЕЛЬ: фоновые задания ====================
+class CreateJobReq(BaseModel):
+    account: str
+    type: str  # "export_members", "chat_history" или "archive"
+    group: Optional[Union[str, int]] = None  # Для export_members
+    chat_id: Optional[Union[str, int]] = None  # Для chat_history и archive
+    limit: Optional[int] = None  # Для chat_history: None — вся история
+
+class ArchiveReq(BaseModel):
+    account: str
+    chat_id: Union[str, int]
+
+# ==================== Пул потоков и контроль event loop ====================
+CPU_EXECUTOR = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu-worker")
+LOOP_STATS = {
+    "checks": 0, "stalls": 0, "max_lag_ms": 0.0, "last_lag_ms": 0.0, "last_stall_at": None, "last_stall_stack": None
+}
+# Общее с потоком-сторожем: поток event loop и момент, когда loop_lag_monitor должен проснуться
+LOOP_WATCHDOG = {"thread_id": None, "expected_at": None, "reported_at": None}
+
+
+async def map_in_executor(func, items: list, chunk_size: int = CPU_CHUNK_SIZE) -> list:
+    """
+    Применить func к каждому элементу в пуле потоков порциями по chunk_size.
+    Между порциями управление возвращается в event loop, поэтому обновления
+    и запросы других аккаунтов не ждут окончания большого преобразования.
+    Пул потоков, а не процессов: объекты Telethon дорого сериализовать между процессами.
+    """
+    loop = asyncio.get_running_loop()
+    result = []
+    for start in range(0, len(items), chunk_size):
+        chunk = items[start:start + chunk_size]
+        result.extend(await loop.run_in_executor(CPU_EXECUTOR, lambda c=chunk: [func(item) for item in c]))
+    return result
+
+
+async def serialize_json_in_executor(data) -> bytes:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        CPU_EXECUTOR,
+        lambda: json.dumps(jsonable_encoder(data), ensure_ascii=False).encode("utf-8")
+    )
+
+
+async def json_response_in_executor(data) -> Response:
+    """Сериализовать большой ответ в JSON вне event loop"""
+    return Response(content=await serialize_json_in_executor(data), media_type="application/json")
+
+
+async def loop_lag_monitor():
+    """Фоновая задача: измеряет, насколько позже запланированного просыпается event loop"""
+    loop = asyncio.get_running_loop()
+    LOOP_WATCHDOG["thread_id"] = threading.get_ident()
+    while True:
+        started = loop.time()
+        LOOP_WATCHDOG["expected_at"] = time.monotonic() + LOOP_MONITOR_INTERVAL
+        await asyncio.sleep(LOOP_MONITOR_INTERVAL)
+        lag = loop.time() - started - LOOP_MONITOR_INTERVAL
+        lag_ms = round(max(lag, 0) * 1000, 2)
+        LOOP_STATS["checks"] += 1
+        LOOP_STATS["last_lag_ms"] = lag_ms
+        LOOP_STATS["max_lag_ms"] = max(LOOP_STATS["max_lag_ms"], lag_ms)
+        if lag >= LOOP_STALL_THRESHOLD:
+            LOOP_STATS["stalls"] += 1
+            LOOP_STATS["last_stall_at"] = datetime.now().isoformat()
+            log_loop.warning("Event loop заблокирован", extra={"lag_ms": lag_ms})
+
+
+def loop_watchdog(stop: threading.Event):
+    """
+    Поток-сторож: если loop_lag_monitor не проснулся вовремя, event loop чем-то
+    занят прямо сейчас — снимаем стек его потока в момент блокировки.
+    Одна запись на каждое зависание.
+    """
+    while not stop.wait(LOOP_MONITOR_INTERVAL / 2):
+        expected = LOOP_WATCHDOG["expected_at"]
+        if expected is None or expected == LOOP_WATCHDOG["reported_at"]:
+            continue
+        lag = time.monotonic() - expected
+        if lag < LOOP_STALL_THRESHOLD:
+            continue
+        frame = sys._current_frames().get(LOOP_WATCHDOG["thread_id"])
+        if frame is None:
+            continue
+        stack = "".join(traceback.format_stack(frame))
+        LOOP_WATCHDOG["reported_at"] = expected
+        LOOP_STATS["last_stall_stack"] = stack
+        log_loop.warning("Event loop заблокирован, стек потока", extra={"lag_ms": round(lag * 1000, 2), "stack": stack})
+
+
+def start_loop_watchdog() -> threading.Event:
+    stop = threading.Event()
+    threading.Thread(target=loop_watchdog, args=(stop,), name="loop-watchdog", daemon=True).start()
+    return stop
+
+
+def sample_stacks(seconds: float, interval: float, thread_ids: Optional[set]) -> tuple:
+    """
+    Сэмплирующий профилировщик: каждые interval секунд снимает стеки потоков
+    (всех или только thread_ids) и считает одинаковые. Возвращает
+    (число сэмплов, {"поток;внешний кадр;...;внутренний кадр": count}).
+    """
+    me = threading.get_ident()
+    counts: Dict[str, int] = {}
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me or (thread_ids is not None and thread_id not in thread_ids):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return samples, counts
+
+
 # ==================== Вспомогательные функции ====================
 def extract_folder_title(folder_obj):
     if not hasattr(folder_obj, 'title'):
@@ -145,199 +605,924 @@ def extract_folder_title(folder_obj):
     return None
 
 
-async def get_dialogs_with_folders_info(client: TelegramClient, limit: int = 50) -> List[DialogInfo]:
+def build_sender_info(sender) -> dict:
+    """Сформировать словарь с информацией об отправителе (пользователь, группа или канал)"""
+    sender_info = {
+        "id": sender.id,
+        "first_name": getattr(sender, 'first_name', ''),
+        "last_name": getattr(sender, 'last_name', ''),
+        "username": getattr(sender, 'username', None),
+        "phone": getattr(sender, 'phone', None),
+        "is_bot": getattr(sender, 'bot', False),
+        "is_premium": getattr(sender, 'premium', False),
+        "is_verified": getattr(sender, 'verified', False),
+        "is_restricted": getattr(sender, 'restricted', False),
+        "is_scam": getattr(sender, 'scam', False),
+        "is_fake": getattr(sender, 'fake', False),
+        "is_support": getattr(sender, 'support', False),
+        "is_contact": getattr(sender, 'contact', False),
+        "is_deleted": getattr(sender, 'deleted', False),
+        "is_self": getattr(sender, 'self', False),
+        "is_mutual_contact": getattr(sender, 'mutual_contact', False),
+    }
+    
+    # Информация о чате (если отправитель - группа или канал)
+    if hasattr(sender, 'title'):
+        sender_info["title"] = sender.title
+        sender_info["is_channel"] = getattr(sender, 'broadcast', False)
+        sender_info["is_group"] = getattr(sender, 'megagroup', False) or getattr(sender, 'gigagroup', False)
+        sender_info["participants_count"] = getattr(sender, 'participants_count', None)
+    
+    # Статус (онлайн/офлайн)
+    if hasattr(sender, 'status'):
+        status = sender.status
+        if hasattr(status, '__class__'):
+            sender_info["status"] = status.__class__.__name__
+            if hasattr(status, 'was_online'):
+                sender_info["last_seen"] = status.was_online.isoformat() if status.was_online else None
+            if hasattr(status, 'expires'):
+                sender_info["status_expires"] = status.expires.isoformat() if status.expires else None
+    
+    return sender_info
+
+
+def build_message_info(message) -> dict:
+    """Краткая информация о сообщении для ответов get_sender_info"""
+    return {
+        "id": message.id,
+        "date": message.date.isoformat() if hasattr(message, 'date') and message.date else None,
+        "text": message.text if hasattr(message, 'text') else message.message if hasattr(message, 'message') else "",
+        "is_outgoing": message.out if hasattr(message, 'out') else False,
+        "is_forward": bool(message.forward) if hasattr(message, 'forward') else False,
+        "has_media": bool(message.media) if hasattr(message, 'media') else False,
+        "has_reply": bool(message.reply_to) if hasattr(message, 'reply_to') else False,
+    }
+
+
+def get_client(account: str) -> TelegramClient:
+    """Клиент аккаунта или 400; заодно добавляет аккаунт в контекст логов запроса"""
+    client = ACTIVE_CLIENTS.get(account)
+    if not client:
+        raise HTTPException(400, detail=f"Аккаунт не найден: {account}")
+    LOG_CONTEXT.set({**LOG_CONTEXT.get(), "account": account})
+    return client
+
+
+def normalize_chat_id(chat_id: Union[str, int]) -> Union[str, int]:
+    """Привести chat_id к виду, который понимает Telethon: '@name' → 'name', '-100123' → -100123"""
+    if isinstance(chat_id, str):
+        if chat_id.startswith('@'):
+            chat_id = chat_id[1:]
+        if chat_id.lstrip('-').isdigit():
+            chat_id = int(chat_id)
+    return chat_id
+
+
+def build_chat_message(msg) -> Optional[ChatMessage]:
+    """ChatMessage для /chat_history; None — если сообщение пустое"""
+    if msg is None:
+        return None
+        
+    text = ""
+    if hasattr(msg, 'text') and msg.text:
+        text = msg.text
+    elif hasattr(msg, 'message') and msg.message:
+        text = msg.message
+    
+    if not text and not hasattr(msg, 'media'):
+        return None
+    
+    return ChatMessage(
+        id=msg.id,
+        date=msg.date.isoformat() if msg.date else "",
+        from_id=None,
+        text=text,
+        is_outgoing=msg.out if hasattr(msg, 'out') else False
+    )
+
+
+def chat_display_title(chat) -> str:
+    if hasattr(chat, 'title'):
+        return chat.title
+    if hasattr(chat, 'first_name'):
+        chat_title = chat.first_name
+        if hasattr(chat, 'last_name') and chat.last_name:
+            chat_title += f" {chat.last_name}"
+        return chat_title
+    return "Unknown"
+
+
+async def resolve_chat(account: str, client: TelegramClient, chat_id: Union[str, int]):
+    """Найти сущность чата; если get_entity не справился — ищем среди диалогов"""
+    normalized = normalize_chat_id(chat_id)
+    try:
+        return await resolve_entity(account, client, normalized)
+    except Exception:
+        dialogs = await fetch_dialogs(account, client, None)
+        for dialog in dialogs:
+            if str(dialog.id) == str(normalized) or (hasattr(dialog.entity, 'username') and dialog.entity.username == normalized):
+                return dialog.entity
+        raise HTTPException(400, detail=f"Не удалось найти чат: {chat_id}")
+
+
+# Свойства Message Telethon в порядке проверки: голосовые, стикеры и видео — тоже документы
+MEDIA_PREVIEW_TYPES = (
+    "photo", "sticker", "voice", "video_note", "gif", "video", "audio", "document",
+    "web_preview", "contact", "poll", "venue", "geo", "dice", "game", "invoice",
+)
+
+
+def message_media_type(msg) -> Optional[str]:
+    if not getattr(msg, 'media', None):
+        return None
+    for media_type in MEDIA_PREVIEW_TYPES:
+        if getattr(msg, media_type, None):
+            return media_type
+    return type(msg.media).__name__.removeprefix("MessageMedia").lower()
+
+
+def build_message_preview(msg) -> Optional[MessagePreview]:
+    """Превью из сообщения, которое GetDialogs уже вернул вместе с диалогом"""
+    if msg is None:
+        return None
+    return MessagePreview(
+        id=msg.id,
+        text=(getattr(msg, 'message', None) or "")[:PREVIEW_TEXT_LENGTH],
+        sender_id=getattr(msg, 'sender_id', None),
+        is_outgoing=bool(getattr(msg, 'out', False)),
+        media_type=message_media_type(msg)
+    )
+
+
+def dialog_to_info(dialog, dialog_to_folders: Dict[int, List[str]], include_preview: bool = False) -> DialogInfo:
+    """Преобразовать Dialog Telethon в DialogInfo"""
+    entity = dialog.entity
+    return DialogInfo(
+        id=entity.id,
+        title=dialog.title or dialog.name or "Без названия",
+        username=getattr(entity, 'username', None),
+        folder_names=dialog_to_folders.get(entity.id, []),
+        is_group=getattr(entity, 'megagroup', False) or getattr(entity, 'gigagroup', False),
+        is_channel=getattr(entity, 'broadcast', False),
+        is_user=hasattr(entity, 'first_name'),
+        unread_count=dialog.unread_count,
+        last_message_date=dialog.date.isoformat() if dialog.date else None,
+        last_message=build_message_preview(dialog.message) if include_preview else None
+    )
+
+
+def build_folder_index(dialog_filters) -> Dict[int, List[str]]:
+    """Индекс peer_id → названия папок, в которые диалог включён явно"""
+    dialog_to_folders: Dict[int, List[str]] = {}
+    for folder in dialog_filters:
+        folder_title = extract_folder_title(folder)
+        if not (hasattr(folder, 'id') and folder_title):
+            continue
+        
+        for peer in getattr(folder, 'include_peers', []):
+            peer_id = None
+            if hasattr(peer, 'user_id'):
+                peer_id = peer.user_id
+            elif hasattr(peer, 'chat_id'):
+                peer_id = peer.chat_id
+            elif hasattr(peer, 'channel_id'):
+                peer_id = peer.channel_id
+            
+            if peer_id:
+                dialog_to_folders.setdefault(peer_id, []).append(folder_title)
+    return dialog_to_folders
+
+
+async def dialogs_to_info(dialogs, dialog_to_folders: Optional[Dict[int, List[str]]] = None,
+                          include_preview: bool = False) -> List[DialogInfo]:
+    """Построить DialogInfo в пуле потоков, чтобы большие списки не блокировали event loop"""
+    return await map_in_executor(
+        partial(dialog_to_info, dialog_to_folders=dialog_to_folders or {}, include_preview=include_preview),
+        list(dialogs)
+    )
+
+
+async def get_dialogs_with_folders_info(account: str, client: TelegramClient, limit: int = 50,
+                                        include_preview: bool = False) -> List[DialogInfo]:
     """Получить диалоги с информацией о папках"""
     try:
-        folder_info = {}
+        dialog_to_folders = {}
         try:
-            dialog_filters_result = await client(GetDialogFiltersRequest())
+            dialog_filters_result = await fetch_dialog_filters(account, client)
             dialog_filters = getattr(dialog_filters_result, 'filters', [])
-            
-            for folder in dialog_filters:
-                folder_title = extract_folder_title(folder)
-                
-                if hasattr(folder, 'id') and folder_title:
-                    folder_info[folder.id] = {
-                        'title': folder_title,
-                        'include_peers': [],
-                        'exclude_peers': []
-                    }
-                    
-                    if hasattr(folder, 'include_peers'):
-                        for peer in folder.include_peers:
-                            peer_id = None
-                            if hasattr(peer, 'user_id'):
-                                peer_id = peer.user_id
-                            elif hasattr(peer, 'chat_id'):
-                                peer_id = peer.chat_id
-                            elif hasattr(peer, 'channel_id'):
-                                peer_id = peer.channel_id
-                            
-                            if peer_id:
-                                folder_info[folder.id]['include_peers'].append(peer_id)
+            dialog_to_folders = build_folder_index(dialog_filters)
         except Exception as e:
-            print(f"Ошибка получения папок: {e}")
-        
-        dialogs = await client.get_dialogs(limit=limit)
-        dialog_to_folders = {}
-        
-        for folder_id, folder_data in folder_info.items():
-            for peer_id in folder_data['include_peers']:
-                if peer_id not in dialog_to_folders:
-                    dialog_to_folders[peer_id] = []
-                dialog_to_folders[peer_id].append(folder_data['title'])
-        
-        dialog_list = []
-        for dialog in dialogs:
-            entity = dialog.entity
-            folder_names = []
-            dialog_id = entity.id
-            
-            if dialog_id in dialog_to_folders:
-                folder_names = dialog_to_folders[dialog_id]
-            
-            dialog_info = DialogInfo(
-                id=entity.id,
-                title=dialog.title or dialog.name or "Без названия",
-                username=getattr(entity, 'username', None),
-                folder_names=folder_names,
-                is_group=getattr(entity, 'megagroup', False) or getattr(entity, 'gigagroup', False),
-                is_channel=getattr(entity, 'broadcast', False),
-                is_user=hasattr(entity, 'first_name'),
-                unread_count=dialog.unread_count,
-                last_message_date=dialog.date.isoformat() if dialog.date else None
-            )
-            dialog_list.append(dialog_info)
+            log_dialogs.warning("Ошибка получения папок: %s", e)
         
-        return dialog_list
+        dialogs = await fetch_dialogs(account, client, limit)
+        return await dialogs_to_info(dialogs, dialog_to_folders, include_preview)
         
     except Exception as e:
-        print(f"Ошибка получения диалогов: {e}")
-        dialogs = await client.get_dialogs(limit=limit)
-        return [DialogInfo(
-            id=dialog.entity.id,
-            title=dialog.title or dialog.name or "Без названия",
-            username=getattr(dialog.entity, 'username', None),
-            folder_names=[],
-            is_group=getattr(dialog.entity, 'megagroup', False) or getattr(dialog.entity, 'gigagroup', False),
-            is_channel=getattr(dialog.entity, 'broadcast', False),
-            is_user=hasattr(dialog.entity, 'first_name'),
-            unread_count=dialog.unread_count,
-            last_message_date=dialog.date.isoformat() if dialog.date else None
-        ) for dialog in dialogs]
+        log_dialogs.warning("Ошибка получения диалогов: %s", e)
+        dialogs = await fetch_dialogs(account, client, limit)
+        return await dialogs_to_info(dialogs, include_preview=include_preview)
 
 
-# ==================== Lifespan ====================
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    print("Telegram Multi Gateway запущен")
-    yield
-    for client in ACTIVE_CLIENTS.values():
-        await client.disconnect()
-    print("Все аккаунты отключены")
+# Булевы признаки участника, упакованные в битовое поле flags: бит i ↔ MEMBER_FLAGS[i]
+MEMBER_FLAGS = (
+    "is_admin", "is_bot", "is_self", "is_contact", "is_mutual_contact", "is_deleted",
+    "is_verified", "is_restricted", "is_scam", "is_fake", "is_support", "is_premium",
+)
+MEMBER_COLUMNS = ("id", "username", "first_name", "last_name", "phone", "admin_title", "status", "last_seen", "flags")
+# Атрибут User для каждого признака, кроме is_admin
+MEMBER_FLAG_ATTRS = {flag: flag[3:] for flag in MEMBER_FLAGS if flag != "is_admin"}
+_ABSENT = object()  # Поле status/last_seen отсутствует (в отличие от значения None)
 
 
-app = FastAPI(title="Telegram Multi Account Gateway", lifespan=lifespan)
+class MemberRecord:
+    """Компактная запись участника: строки + одно целое с флагами вместо словаря на 20 ключей"""
+    __slots__ = ("id", "username", "first_name", "last_name", "phone", "admin_title", "status", "last_seen", "flags")
 
+    def to_row(self) -> list:
+        return [
+            self.id, self.username, self.first_name, self.last_name, self.phone, self.admin_title,
+            None if self.status is _ABSENT else self.status,
+            None if self.last_seen is _ABSENT else self.last_seen,
+            self.flags,
+        ]
 
-# ==================== Авторизация ====================
-@app.post("/auth/start")
-async def auth_start(req: AuthStartReq):
-    """Начать авторизацию: запросить код подтверждения"""
-    client = TelegramClient(StringSession(), API_ID, API_HASH)
-    await client.connect()
-    
-    try:
-        sent_code = await client.send_code_request(req.phone)
-        session_str = client.session.save()
-        
-        PENDING_AUTH[req.phone] = {
-            "session_str": session_str,
-            "phone_code_hash": sent_code.phone_code_hash,
-            "needs_2fa": False
+    def to_dict(self) -> dict:
+        """Прежний формат /export_members"""
+        member_data = {
+            "id": self.id,
+            "username": self.username,
+            "first_name": self.first_name,
+            "last_name": self.last_name,
+            "phone": self.phone,
+            "is_admin": bool(self.flags & 1),
+            "admin_title": self.admin_title,
         }
-        
-        await client.disconnect()
-        
-        return {
-            "status": "code_sent",
-            "phone": req.phone,
-            "phone_code_hash": sent_code.phone_code_hash,
-            "needs_2fa": False
-        }
-    except Exception as e:
-        await client.disconnect()
-        raise HTTPException(400, detail=f"Ошибка: {str(e)}")
+        for bit, flag in enumerate(MEMBER_FLAGS[1:], start=1):
+            member_data[flag] = bool(self.flags >> bit & 1)
+        if self.status is not _ABSENT:
+            member_data["status"] = self.status
+        if self.last_seen is not _ABSENT:
+            member_data["last_seen"] = self.last_seen
+        return member_data
 
 
-@app.post("/auth/complete")
-async def auth_complete(req: AuthCodeReq):
-    """
-    Завершить авторизацию.
-    Автоматически определяет нужен ли 2FA.
-    """
-    pending_data = PENDING_AUTH.get(req.phone)
-    if not pending_data:
-        raise HTTPException(400, "Нет активной авторизации")
+def build_member_record(p) -> MemberRecord:
+    """Компактная запись участника группы для /export_members"""
+    # Определяем, является ли участник администратором
+    is_admin = False
+    admin_title = None
     
-    client = TelegramClient(StringSession(pending_data["session_str"]), API_ID, API_HASH)
-    await client.connect()
+    # Проверяем разные способы определения администратора
+    if hasattr(p, 'participant'):
+        # Для участников групп/каналов
+        participant = p.participant
+        if hasattr(participant, 'admin_rights') and participant.admin_rights:
+            is_admin = True
+            admin_title = getattr(participant, 'rank', None) or getattr(participant, 'title', None)
     
-    try:
-        # 1. Пробуем войти с кодом
-        try:
-            await client.sign_in(
-                phone=req.phone,
-                code=req.code,
-                phone_code_hash=pending_data["phone_code_hash"]
-            )
-            
-        # 2. Если нужен пароль 2FA
-        except SessionPasswordNeededError:
-            # Обновляем статус в PENDING_AUTH
-            PENDING_AUTH[req.phone]["needs_2fa"] = True
-            
-            # Если пароль уже предоставлен в этом же запросе
-            if req.password:
-                try:
-                    await client.sign_in(password=req.password)
-                except Exception as e:
-                    await client.disconnect()
-                    raise HTTPException(400, detail=f"Ошибка пароля 2FA: {str(e)}")
-            else:
-                await client.disconnect()
-                # Возвращаем специальный статус для запроса пароля
-                return {
-                    "status": "2fa_required",
-                    "phone": req.phone,
-                    "needs_2fa": True,
-                    "message": "Требуется пароль двухфакторной аутентификации",
-                    "instructions": "Используйте /auth/2fa с параметром password"
-                }
-        
-        # 3. Если другие ошибки с кодом
-        except Exception as e:
-            await client.disconnect()
-            raise HTTPException(400, detail=f"Ошибка кода: {str(e)}")
-        
-        # 4. Если успешно (с кодом или кодом+паролем)
-        session_str = client.session.save()
-        del PENDING_AUTH[req.phone]
-        await client.disconnect()
-        
-        return {
-            "status": "success",
-            "session_string": session_str,
-            "message": "Авторизация успешна"
-        }
-        
-    except Exception as e:
-        await client.disconnect()
-        raise HTTPException(500, detail=f"Неожиданная ошибка: {str(e)}")
+    # Альтернативная проверка через права
+    if not is_admin and hasattr(p, 'admin_rights') and p.admin_rights:
+        is_admin = True
+    
+    record = MemberRecord()
+    record.id = p.id
+    record.username = getattr(p, 'username', None) or None
+    record.first_name = getattr(p, 'first_name', None) or ""
+    record.last_name = getattr(p, 'last_name', None) or ""
+    record.phone = getattr(p, 'phone', None) or None
+    record.admin_title = admin_title
+    
+    flags = 1 if is_admin else 0
+    for bit, flag in enumerate(MEMBER_FLAGS[1:], start=1):
+        if getattr(p, MEMBER_FLAG_ATTRS[flag], False):
+            flags |= 1 << bit
+    record.flags = flags
+    
+    # Статус (онлайн/офлайн)
+    record.status = _ABSENT
+    record.last_seen = _ABSENT
+    if hasattr(p, 'status'):
+        status = p.status
+        if hasattr(status, '__class__'):
+            record.status = status.__class__.__name__
+            if hasattr(status, 'was_online'):
+                record.last_seen = status.was_online.isoformat() if status.was_online else None
+    
+    return record
 
 
-@app.post("/auth/2fa")
-async def auth_2fa(req: Auth2FAReq):
+def build_member_data(p) -> dict:
+    """Словарь с информацией об участнике группы для /export_members"""
+    return build_member_record(p).to_dict()
+
+
+# ==================== Индекс контактов ====================
+def contact_entry(user, phone: str = "") -> dict:
+    """Запись индекса контактов из объекта User"""
+    return {
+        "phone": getattr(user, 'phone', None) or phone or "",
+        "first_name": getattr(user, 'first_name', None) or "",
+        "last_name": getattr(user, 'last_name', None) or "",
+        "username": getattr(user, 'username', None),
+    }
+
+
+def telegram_ids_hash(ids) -> int:
+    """Хэш списка ID для кэширующих запросов Telegram (алгоритм из документации API, 64 бита со знаком)"""
+    mask = (1 << 64) - 1
+    value = 0
+    for item_id in ids:
+        value ^= value >> 21
+        value ^= (value << 35) & mask
+        value ^= value >> 4
+        value = (value + item_id) & mask
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+async def load_contacts_index(account: str, client: TelegramClient, only_if_missing: bool = False) -> Dict[int, dict]:
+    """
+    Загрузить или сверить индекс с Telegram. Для уже загруженного индекса
+    передаётся хэш: если контакты не менялись, Telegram отвечает ContactsNotModified.
+    """
+    lock = CONTACTS_INDEX_LOCKS.setdefault(account, asyncio.Lock())
+    async with lock:
+        index = CONTACTS_INDEX.get(account)
+        if index is not None and only_if_missing:
+            return index
+        result = await client(GetContactsRequest(hash=CONTACTS_INDEX_HASHES.get(account, 0) if index is not None else 0))
+        CONTACTS_INDEX_LOADED_AT[account] = time.monotonic()
+        if isinstance(result, types.contacts.ContactsNotModified):
+            return index
+        index = {user.id: contact_entry(user) for user in getattr(result, 'users', [])}
+        CONTACTS_INDEX[account] = index
+        # Хэш contacts.getContacts: сначала saved_count из прошлого ответа, затем ID контактов по возрастанию
+        CONTACTS_INDEX_HASHES[account] = telegram_ids_hash(
+            [result.saved_count, *sorted(contact.user_id for contact in result.contacts)]
+        )
+        log_contacts.info("Индекс контактов загружен", extra={"account": account, "contacts": len(index)})
+        return index
+
+
+async def get_contacts_index(account: str, client: TelegramClient) -> Dict[int, dict]:
+    """
+    Индекс контактов аккаунта (id → телефон/имя).
+    Загружается один раз через GetContactsRequest, дальше поддерживается
+    обновлениями Telegram и вызовами add/delete самого шлюза.
+    """
+    index = CONTACTS_INDEX.get(account)
+    if index is not None:
+        return index
+    return await load_contacts_index(account, client, only_if_missing=True)
+
+
+async def find_contact(account: str, client: TelegramClient, user_id: int) -> Optional[dict]:
+    """
+    Контакт из индекса. При промахе индекс один раз сверяется с Telegram:
+    контакт могли добавить из приложения, а такие изменения не приходят обновлениями.
+    Сверка не чаще раза в CONTACTS_RELOAD_INTERVAL: поток запросов с чужими ID
+    не должен каждый раз гонять GetContactsRequest.
+    """
+    contact = (await get_contacts_index(account, client)).get(user_id)
+    if contact is None and time.monotonic() - CONTACTS_INDEX_LOADED_AT.get(account, 0) >= CONTACTS_RELOAD_INTERVAL:
+        contact = (await load_contacts_index(account, client)).get(user_id)
+    return contact
+
+
+def add_to_contacts_index(account: str, users, phone: str = ""):
+    """Добавить пользователей в индекс (если индекс уже загружен)"""
+    index = CONTACTS_INDEX.get(account)
+    if index is None:
+        return
+    for user in users:
+        index[user.id] = contact_entry(user, phone)
+
+
+def remove_from_contacts_index(account: str, user_ids):
+    index = CONTACTS_INDEX.get(account)
+    if index is None:
+        return
+    for user_id in user_ids:
+        index.pop(user_id, None)
+
+
+async def contacts_update_handler(account: str, update):
+    """Синхронизация индекса контактов по обновлениям Telegram"""
+    index = CONTACTS_INDEX.get(account)
+    if index is None:
+        return
+
+    if isinstance(update, types.UpdateContactsReset):
+        # Telegram просит перечитать контакты — перезагрузим при следующем обращении
+        CONTACTS_INDEX.pop(account, None)
+    elif isinstance(update, types.UpdateUserPhone):
+        if update.user_id in index:
+            index[update.user_id]["phone"] = update.phone
+    elif isinstance(update, types.UpdateUserName):
+        entry = index.get(update.user_id)
+        if entry:
+            entry["first_name"] = update.first_name or ""
+            entry["last_name"] = update.last_name or ""
+            usernames = getattr(update, 'usernames', None) or []
+            entry["username"] = usernames[0].username if usernames else entry.get("username")
+
+
+CONTACT_UPDATE_TYPES = [types.UpdateContactsReset, types.UpdateUserPhone, types.UpdateUserName]
+
+
+# ==================== Кэш сущностей и обогащение payload ====================
+# Поле payload → (чья сущность, ключ метаданных)
+ENRICH_FIELD_SOURCES = {
+    "sender_name": ("sender", "name"),
+    "sender_username": ("sender", "username"),
+    "sender_phone": ("sender", "phone"),
+    "sender_type": ("sender", "type"),
+    "chat_title": ("chat", "name"),
+    "chat_username": ("chat", "username"),
+    "chat_type": ("chat", "type"),
+}
+
+
+def entity_meta(entity) -> dict:
+    """Компактные метаданные сущности для кэша и обогащения"""
+    if hasattr(entity, 'first_name'):
+        entity_type = "bot" if getattr(entity, 'bot', False) else "user"
+    elif getattr(entity, 'broadcast', False):
+        entity_type = "channel"
+    elif getattr(entity, 'megagroup', False) or getattr(entity, 'gigagroup', False):
+        entity_type = "supergroup"
+    else:
+        entity_type = "group"
+    return {
+        "name": utils.get_display_name(entity) or None,
+        "username": getattr(entity, 'username', None),
+        "phone": getattr(entity, 'phone', None),
+        "type": entity_type,
+    }
+
+
+def remember_entities(account: str, entities):
+    """Положить сущности, уже полученные от Telegram, в локальный кэш аккаунта"""
+    cache = ENTITY_CACHE.setdefault(account, {})
+    for entity in entities:
+        if entity is None or not hasattr(entity, 'id'):
+            continue
+        try:
+            peer_id = utils.get_peer_id(entity)
+        except (TypeError, ValueError):
+            continue
+        cache.pop(peer_id, None)
+        cache[peer_id] = entity_meta(entity)
+        if len(cache) > ENTITY_CACHE_SIZE:
+            # Вытесняем самую старую запись (dict хранит порядок вставки)
+            cache.pop(next(iter(cache)))
+
+
+def enrich_payload(payload: dict, account: str, event):
+    """
+    Добавить в payload поля из WEBHOOK_ENRICH_FIELDS.
+    Данные берутся только из сущностей самого обновления или из ENTITY_CACHE,
+    без дополнительных запросов к Telegram.
+    """
+    cache = ENTITY_CACHE.get(account, {})
+    metas = {}
+    for role, peer_id in (("sender", payload.get("sender_id")), ("chat", payload.get("chat_id"))):
+        entity = getattr(event, role, None)
+        if entity is not None:
+            remember_entities(account, [entity])
+            metas[role] = entity_meta(entity)
+        else:
+            metas[role] = cache.get(peer_id)
+
+    for field in WEBHOOK_ENRICH_FIELDS:
+        source = ENRICH_FIELD_SOURCES.get(field)
+        if not source:
+            continue
+        meta = metas.get(source[0])
+        payload[field] = meta.get(source[1]) if meta else None
+
+
+# ==================== Версии данных и условные запросы (ETag) ====================
+# Обновления, которые меняют список диалогов, но не относятся к одному диалогу
+# (изменения конкретного диалога определяет changed_dialog_peer)
+DIALOG_LIST_UPDATES = (
+    types.UpdatePinnedDialogs, types.UpdateFolderPeers, types.UpdateDeleteMessages,
+)
+FOLDER_UPDATES = (types.UpdateDialogFilter, types.UpdateDialogFilters, types.UpdateDialogFilterOrder)
+
+
+def bump_version(account: str, *kinds: str):
+    versions = ACCOUNT_VERSIONS.setdefault(account, {})
+    for kind in kinds:
+        versions[kind] = versions.get(kind, 0) + 1
+    # Закэшированные ответы прежней версии уже не пригодятся
+    for key in [k for k in RESPONSE_CACHE if k[0] == account and k[1] in kinds]:
+        del RESPONSE_CACHE[key]
+
+
+def get_version(account: str, kind: str) -> int:
+    return ACCOUNT_VERSIONS.get(account, {}).get(kind, 0)
+
+
+async def account_update_handler(account: str, update):
+    """Общий обработчик сырых обновлений аккаунта: версии для ETag и индекс контактов"""
+    peer_id = changed_dialog_peer(update)
+    if isinstance(update, FOLDER_UPDATES):
+        bump_version(account, "folders", "dialogs")
+    elif peer_id is not None or isinstance(update, DIALOG_LIST_UPDATES):
+        bump_version(account, "dialogs")
+
+    if peer_id is not None:
+        record_dialog_change(account, peer_id)
+    forget_top_messages(account, update, peer_id)
+
+    if isinstance(update, tuple(CONTACT_UPDATE_TYPES)):
+        await contacts_update_handler(account, update)
+
+
+def note_outgoing(account: str, peer):
+    """
+    Учесть сообщение, отправленное самим шлюзом в чат peer. Обновления из ответов
+    на собственные запросы Telethon обработчикам не передаёт, поэтому
+    account_update_handler их не видит — все пути отправки вызывают эту функцию.
+    """
+    peer_id = utils.get_peer_id(peer)
+    bump_version(account, "dialogs")
+    record_dialog_change(account, peer_id)
+    # Последнее сообщение чата теперь наше — закэшированное из GetDialogs устарело
+    TOP_MESSAGES.get(account, {}).pop(peer_id, None)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+
+async def conditional_json(request: Request, key: tuple, version: int, build) -> Response:
+    """
+    Ответ с ETag. Пока версия данных не изменилась, повторный опрос отдаёт
+    304 (или закэшированное тело) без запросов к Telegram и без сериализации.
+    version нужно считать до вызова build: обновление во время загрузки
+    сделает кэш устаревшим для следующего запроса.
+    """
+    entry = RESPONSE_CACHE.get(key)
+    if entry and (entry["version"] != version or time.monotonic() - entry["fetched_at"] > CONDITIONAL_CACHE_TTL):
+        entry = None
+
+    if entry is None:
+        body = await serialize_json_in_executor(await build())
+        entry = {
+            "version": version,
+            "etag": '"' + hashlib.sha1(body).hexdigest()[:20] + '"',
+            "body": body,
+            "fetched_at": time.monotonic(),
+        }
+        RESPONSE_CACHE[key] = entry
+
+    headers = {"ETag": entry["etag"], "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), entry["etag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["body"], media_type="application/json", headers=headers)
+
+
+def drop_account_cache(account: str):
+    ACCOUNT_VERSIONS.pop(account, None)
+    DIALOG_CHANGES.pop(account, None)
+    for key in [k for k in RESPONSE_CACHE if k[0] == account]:
+        RESPONSE_CACHE.pop(key, None)
+
+
+# ==================== Single-flight: объединение одинаковых запросов ====================
+def _forget_flight(key: tuple, task: asyncio.Future):
+    if SINGLE_FLIGHT.get(key) is task:
+        del SINGLE_FLIGHT[key]
+    # Забираем исключение, даже если все ожидающие уже отменены
+    if not task.cancelled():
+        task.exception()
+
+
+async def single_flight(key: tuple, factory):
+    """
+    Выполнить factory() один раз для всех одновременных вызовов с тем же ключом.
+    key = (аккаунт, вид вызова, параметры...). Отмена одного ожидающего
+    не отменяет общий запрос для остальных.
+    """
+    stats = SINGLE_FLIGHT_STATS.setdefault(key[1], {"calls": 0, "executions": 0})
+    stats["calls"] += 1
+    task = SINGLE_FLIGHT.get(key)
+    if task is None:
+        stats["executions"] += 1
+        task = asyncio.ensure_future(factory())
+        SINGLE_FLIGHT[key] = task
+        task.add_done_callback(partial(_forget_flight, key))
+    return await asyncio.shield(task)
+
+
+async def resolve_entity(account: str, client: TelegramClient, peer):
+    return await single_flight((account, "get_entity", repr(peer)), lambda: client.get_entity(peer))
+
+
+async def fetch_dialog_filters(account: str, client: TelegramClient):
+    return await single_flight((account, "dialog_filters"), lambda: client(GetDialogFiltersRequest()))
+
+
+async def fetch_dialogs(account: str, client: TelegramClient, limit: Optional[int]):
+    async def load():
+        since_seq = dialog_change_log(account)["seq"]
+        dialogs = await client.get_dialogs(limit=limit)
+        remember_top_messages(account, dialogs, since_seq)
+        return dialogs
+
+    return await single_flight((account, "get_dialogs", limit), load)
+
+
+def remember_top_messages(account: str, dialogs, since_seq: int):
+    """Запомнить последние сообщения диалогов; чаты, изменившиеся во время загрузки, пропускаем"""
+    log = dialog_change_log(account)
+    changed = {peer_id for seq, peer_id in log["log"] if seq > since_seq} if log["seq"] > since_seq else set()
+    cache = TOP_MESSAGES.setdefault(account, {})
+    for dialog in dialogs:
+        if dialog.message is not None and dialog.id not in changed:
+            cache[dialog.id] = dialog.message
+
+
+def forget_top_messages(account: str, update, peer_id: Optional[int]):
+    cache = TOP_MESSAGES.get(account)
+    if not cache:
+        return
+    if peer_id is not None:
+        cache.pop(peer_id, None)
+    elif isinstance(update, types.UpdateDeleteMessages):
+        # В личных чатах и группах ID сообщений общие для аккаунта, чат в обновлении не указан
+        deleted = set(update.messages)
+        for chat_peer_id in [p for p, message in cache.items() if message.id in deleted]:
+            del cache[chat_peer_id]
+
+
+# ==================== Контроль нагрузки ====================
+ROUTE_LIMITS = {route: int(limit) for route, limit in parse_log_settings(ROUTE_CONCURRENCY).items()}
+
+
+class AdmissionGate:
+    """
+    Лимит одновременных запросов с ограниченной очередью ожидания.
+    Пока есть свободный слот, запрос проходит сразу; иначе ждёт не дольше
+    ADMISSION_WAIT_TIMEOUT, а при заполненной очереди отклоняется немедленно.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def active(self) -> int:
+        return self.limit - self.semaphore._value
+
+    async def acquire(self) -> bool:
+        if not self.semaphore.locked():
+            await self.semaphore.acquire()
+            self.admitted += 1
+            return True
+        if self.waiting >= ADMISSION_QUEUE_SIZE:
+            self.rejected += 1
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), ADMISSION_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        finally:
+            self.waiting -= 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.semaphore.release()
+
+
+def admission_gate(account: str, route: Optional[str]) -> Optional[AdmissionGate]:
+    limit = ACCOUNT_CONCURRENCY if route is None else ROUTE_LIMITS.get(route)
+    if not limit:
+        return None
+    gate = ADMISSION_GATES.get((account, route))
+    if gate is None:
+        gate = ADMISSION_GATES[(account, route)] = AdmissionGate(limit)
+    return gate
+
+
+@asynccontextmanager
+async def admit(account: str, route: str):
+    """
+    Занять слот маршрута (429 при перегрузке), затем слот аккаунта (503).
+    Сначала более узкий лимит: запрос, ждущий места на маршруте,
+    не держит слот аккаунта.
+    """
+    acquired = []
+    try:
+        for gate_route, status in ((route, 429), (None, 503)):
+            gate = admission_gate(account, gate_route)
+            if gate is None:
+                continue
+            if not await gate.acquire():
+                log_admission.warning("Запрос отклонён", extra={
+                    "account": account, "limit_route": route, "scope": gate_route or "account",
+                    "active": gate.active, "waiting": gate.waiting
+                })
+                raise HTTPException(
+                    status_code=status,
+                    detail=f"Слишком много одновременных запросов для '{account}', повторите позже",
+                    headers={"Retry-After": str(ADMISSION_RETRY_AFTER)}
+                )
+            acquired.append(gate)
+        yield
+    finally:
+        for gate in acquired:
+            gate.release()
+
+
+def admission_controlled(route: str):
+    """Декоратор эндпоинта: аккаунт берётся из тела запроса (req.account) или параметра account"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            account = getattr(kwargs.get("req"), "account", None) or kwargs.get("account")
+            if account not in ACTIVE_CLIENTS:
+                # Ошибку про неизвестный аккаунт вернёт сам эндпоинт
+                return await func(*args, **kwargs)
+            async with admit(account, route):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def hold_admission(account: str, route: str):
+    """
+    Занять слот admit() на всё время потокового ответа и вернуть функцию освобождения.
+    Её вызывают и finally генератора, и BackgroundTask ответа: если генератор так
+    и не запустится (клиент отключился раньше), слот всё равно вернётся.
+    Повторный вызов ничего не делает — AsyncExitStack закрывается один раз.
+    """
+    stack = AsyncExitStack()
+    await stack.enter_async_context(admit(account, route))
+    return stack.aclose
+
+
+# ==================== Lifespan ====================
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_app.info("Telegram Multi Gateway запущен")
+    UPDATE_STATES.update(load_update_states())
+    state_saver = asyncio.create_task(update_state_saver())
+    lag_monitor = asyncio.create_task(loop_lag_monitor())
+    watchdog_stop = start_loop_watchdog()
+    webhook_workers = [asyncio.create_task(webhook_worker()) for _ in range(WEBHOOK_WORKERS)]
+    dc_sweeper = asyncio.create_task(dc_pool_sweeper())
+    load_jobs()
+    await restore_accounts()
+    DRAIN_STATE["ready"] = True
+    yield
+    # Новые соединения uvicorn уже не принимает: доделываем начатые запросы и вебхуки
+    DRAIN_STATE["draining"] = True
+    await wait_drained(DRAIN_TIMEOUT)
+    state_saver.cancel()
+    lag_monitor.cancel()
+    watchdog_stop.set()
+    dc_sweeper.cancel()
+    for task in webhook_workers:
+        task.cancel()
+    # Незавершённые задания сохраняют контрольную точку и продолжатся после рестарта
+    for task in JOB_TASKS.values():
+        task.cancel()
+    await asyncio.gather(*JOB_TASKS.values(), return_exceptions=True)
+    if not DRAIN_STATE["handover"]:
+        await snapshot_all_update_states()
+    await asyncio.gather(*(client.disconnect() for client in ACTIVE_CLIENTS.values()), return_exceptions=True)
+    log_app.info("Все аккаунты отключены")
+    LOG_LISTENER.stop()
+
+
+app = FastAPI(title="Telegram Multi Account Gateway", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def request_context_middleware(request: Request, call_next):
+    """request_id и маршрут для всех записей лога внутри запроса"""
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:16]
+    token = LOG_CONTEXT.set({"request_id": request_id, "route": request.url.path})
+    DRAIN_STATE["in_flight"] += 1
+    try:
+        response = await call_next(request)
+    finally:
+        DRAIN_STATE["in_flight"] -= 1
+        LOG_CONTEXT.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
+# ==================== Авторизация ====================
+@app.post("/auth/start")
+async def auth_start(req: AuthStartReq):
+    """Начать авторизацию: запросить код подтверждения"""
+    client = TelegramClient(StringSession(), API_ID, API_HASH)
+    await client.connect()
+    
+    try:
+        sent_code = await client.send_code_request(req.phone)
+        session_str = client.session.save()
+        
+        PENDING_AUTH[req.phone] = {
+            "session_str": session_str,
+            "phone_code_hash": sent_code.phone_code_hash,
+            "needs_2fa": False
+        }
+        
+        await client.disconnect()
+        
+        return {
+            "status": "code_sent",
+            "phone": req.phone,
+            "phone_code_hash": sent_code.phone_code_hash,
+            "needs_2fa": False
+        }
+    except Exception as e:
+        await client.disconnect()
+        raise HTTPException(400, detail=f"Ошибка: {str(e)}")
+
+
+@app.post("/auth/complete")
+async def auth_complete(req: AuthCodeReq):
+    """
+    Завершить авторизацию.
+    Автоматически определяет нужен ли 2FA.
+    """
+    pending_data = PENDING_AUTH.get(req.phone)
+    if not pending_data:
+        raise HTTPException(400, "Нет активной авторизации")
+    
+    client = TelegramClient(StringSession(pending_data["session_str"]), API_ID, API_HASH)
+    await client.connect()
+    
+    try:
+        # 1. Пробуем войти с кодом
+        try:
+            await client.sign_in(
+                phone=req.phone,
+                code=req.code,
+                phone_code_hash=pending_data["phone_code_hash"]
+            )
+            
+        # 2. Если нужен пароль 2FA
+        except SessionPasswordNeededError:
+            # Обновляем статус в PENDING_AUTH
+            PENDING_AUTH[req.phone]["needs_2fa"] = True
+            
+            # Если пароль уже предоставлен в этом же запросе
+            if req.password:
+                try:
+                    await client.sign_in(password=req.password)
+                except Exception as e:
+                    await client.disconnect()
+                    raise HTTPException(400, detail=f"Ошибка пароля 2FA: {str(e)}")
+            else:
+                await client.disconnect()
+                # Возвращаем специальный статус для запроса пароля
+                return {
+                    "status": "2fa_required",
+                    "phone": req.phone,
+                    "needs_2fa": True,
+                    "message": "Требуется пароль двухфакторной аутентификации",
+                    "instructions": "Используйте /auth/2fa с параметром password"
+                }
+        
+        # 3. Если другие ошибки с кодом
+        except Exception as e:
+            await client.disconnect()
+            raise HTTPException(400, detail=f"Ошибка кода: {str(e)}")
+        
+        # 4. Если успешно (с кодом или кодом+паролем)
+        session_str = client.session.save()
+        del PENDING_AUTH[req.phone]
+        await client.disconnect()
+        
+        return {
+            "status": "success",
+            "session_string": session_str,
+            "message": "Авторизация успешна"
+        }
+        
+    except Exception as e:
+        await client.disconnect()
+        raise HTTPException(500, detail=f"Неожиданная ошибка: {str(e)}")
+
+
+@app.post("/auth/2fa")
+async def auth_2fa(req: Auth2FAReq):
     """
     Отдельный эндпоинт для ввода пароля 2FA.
     Используется после получения статуса '2fa_required' от /auth/complete
@@ -372,12 +1557,10 @@ async def auth_2fa(req: Auth2FAReq):
 
 
 # ==================== Работа с аккаунтами ====================
-@app.post("/accounts/add")
-async def add_account(req: AddAccountReq):
-    if req.name in ACTIVE_CLIENTS:
-        raise HTTPException(400, detail=f"Аккаунт {req.name} уже существует")
-
-    client = TelegramClient(StringSession(req.session_string), API_ID, API_HASH)
+async def connect_account(name: str, session_string: str) -> TelegramClient:
+    """Подключить аккаунт: прогрев кэшей, обработчики, задания и догон пропущенных обновлений"""
+    global ACCOUNTS_LIST_VERSION
+    client = TelegramClient(StringSession(session_string), API_ID, API_HASH)
     await client.connect()
 
     if not await client.is_user_authorized():
@@ -388,16 +1571,49 @@ async def add_account(req: AddAccountReq):
 
     try:
         dialogs = await client.get_dialogs(limit=50)
-        print(f"Прогрет кэш для {req.name}: {len(dialogs)} чатов")
+        remember_entities(name, [dialog.entity for dialog in dialogs])
+        log_accounts.info("Прогрет кэш диалогов", extra={"account": name, "dialogs": len(dialogs)})
     except Exception as e:
-        print(f"Ошибка прогрева кэша: {e}")
+        log_accounts.warning("Ошибка прогрева кэша: %s", e, extra={"account": name})
 
-    ACTIVE_CLIENTS[req.name] = client
+    ACTIVE_CLIENTS[name] = client
     client.add_event_handler(
         lambda event: incoming_handler(event),
         events.NewMessage(incoming=True)
     )
+    client.add_event_handler(
+        lambda update, name=name: account_update_handler(name, update),
+        events.Raw()
+    )
+    ACCOUNTS_LIST_VERSION += 1
+
+    try:
+        await get_contacts_index(name, client)
+    except Exception as e:
+        log_contacts.warning("Ошибка загрузки индекса контактов: %s", e, extra={"account": name})
+
+    # Продолжаем задания, прерванные рестартом
+    resume_jobs(name)
 
+    # Догоняем сообщения, пришедшие пока аккаунт был не подключен
+    if "pts" in UPDATE_STATES.get(name, {}):
+        start_catch_up(name, client)
+    else:
+        try:
+            await snapshot_update_state(name, client)
+        except Exception as e:
+            log_updates.warning("Ошибка получения состояния обновлений: %s", e, extra={"account": name})
+
+    return client
+
+
+@app.post("/accounts/add")
+async def add_account(req: AddAccountReq):
+    if req.name in ACTIVE_CLIENTS:
+        raise HTTPException(400, detail=f"Аккаунт {req.name} уже существует")
+
+    await connect_account(req.name, req.session_string)
+    save_accounts_file()
     return {
         "status": "added",
         "account": req.name,
@@ -407,32 +1623,195 @@ async def add_account(req: AddAccountReq):
 
 @app.delete("/accounts/{name}")
 async def remove_account(name: str):
+    global ACCOUNTS_LIST_VERSION
     client = ACTIVE_CLIENTS.pop(name, None)
+    CONTACTS_INDEX.pop(name, None)
+    CONTACTS_INDEX_HASHES.pop(name, None)
+    CONTACTS_INDEX_LOADED_AT.pop(name, None)
+    ENTITY_CACHE.pop(name, None)
+    TOP_MESSAGES.pop(name, None)
+    DC_USAGE.pop(name, None)
+    DC_POOL.pop(name, None)  # Заимствованные соединения закроет client.disconnect()
+    RECENT_DELIVERIES.pop(name, None)
+    for key in [k for k in ADMISSION_GATES if k[0] == name]:
+        ADMISSION_GATES.pop(key, None)
+    drop_account_cache(name)
     if client:
+        ACCOUNTS_LIST_VERSION += 1
+        save_accounts_file()
         await client.disconnect()
         return {"status": "removed", "account": name}
     raise HTTPException(404, detail="Аккаунт не найден")
 
 
 @app.get("/accounts")
-def list_accounts():
-    return {"active_accounts": list(ACTIVE_CLIENTS.keys())}
+async def list_accounts(request: Request):
+    async def build():
+        return {"active_accounts": list(ACTIVE_CLIENTS.keys())}
 
+    return await conditional_json(request, ("", "accounts"), ACCOUNTS_LIST_VERSION, build)
 
-# ==================== НОВЫЙ ЭНДПОИНТ: Получить информацию об отправителе сообщения ====================
-@app.post("/get_sender_info")
-async def get_sender_info(req: GetSenderInfoReq):
-    """
-    Получить информацию об отправителе сообщения по его ID.
-    Возвращает полную информацию о пользователе, который отправил сообщение.
+
+# ==================== Передача работы при деплое ====================
+def load_accounts_file() -> Dict[str, str]:
+    if not ACCOUNTS_FILE or not os.path.exists(ACCOUNTS_FILE):
+        return {}
+    try:
+        with open(ACCOUNTS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        log_accounts.error("Ошибка чтения %s: %s", ACCOUNTS_FILE, e)
+        return {}
+
+
+def save_accounts_file():
+    """Сессии подключённых аккаунтов (секреты: файл доступен только владельцу)"""
+    if not ACCOUNTS_FILE or DRAIN_STATE["handover"]:
+        return
+    sessions = {name: client.session.save() for name, client in ACTIVE_CLIENTS.items()}
+    # Суффикс с pid: при передаче работы старый и новый процесс могут писать одновременно
+    tmp_path = f"{ACCOUNTS_FILE}.{os.getpid()}.tmp"
+    try:
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as f:
+            json.dump(sessions, f)
+        os.replace(tmp_path, ACCOUNTS_FILE)
+    except Exception as e:
+        log_accounts.error("Ошибка сохранения %s: %s", ACCOUNTS_FILE, e)
+
+
+async def restore_accounts():
+    """Подключить аккаунты из ACCOUNTS_FILE параллельно; ошибка одного не мешает остальным"""
+    sessions = load_accounts_file()
+    if not sessions:
+        return
+    results = await asyncio.gather(
+        *(connect_account(name, session) for name, session in sessions.items()), return_exceptions=True
+    )
+    for name, result in zip(sessions, results):
+        if isinstance(result, BaseException):
+            log_accounts.error("Не удалось восстановить аккаунт: %s", getattr(result, 'detail', result),
+                               extra={"account": name})
+    log_accounts.info("Аккаунты восстановлены", extra={"restored": len(ACTIVE_CLIENTS), "total": len(sessions)})
+
+
+def enqueue_webhook(payload: dict):
+    try:
+        WEBHOOK_QUEUE.put_nowait(payload)
+    except asyncio.QueueFull:
+        WEBHOOK_STATS["dropped"] += 1
+        log_webhook.warning("Очередь вебхуков переполнена, сообщение не отправлено", extra={
+            "account": payload["from_account"], "chat_id": payload["chat_id"], "message_id": payload["message_id"]
+        })
+
+
+async def webhook_worker():
+    """Отправка вебхуков из очереди: блокирующий requests.post выполняется в потоке, а не в event loop"""
+    while True:
+        payload = await WEBHOOK_QUEUE.get()
+        WEBHOOK_STATS["in_progress"] += 1
+        try:
+            await asyncio.to_thread(requests.post, WEBHOOK_URL, json=payload, timeout=12)
+            WEBHOOK_STATS["sent"] += 1
+        except Exception as e:
+            WEBHOOK_STATS["failed"] += 1
+            log_webhook.warning("Ошибка отправки вебхука: %s", e, extra={"account": payload["from_account"]})
+        finally:
+            WEBHOOK_STATS["in_progress"] -= 1
+            WEBHOOK_QUEUE.task_done()
+
+
+async def wait_drained(timeout: float):
+    """Дождаться начатых HTTP-запросов и отправки очереди вебхуков, но не дольше timeout"""
+    deadline = time.monotonic() + timeout
+    while DRAIN_STATE["in_flight"] > 0 and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    try:
+        await asyncio.wait_for(WEBHOOK_QUEUE.join(), max(deadline - time.monotonic(), 0))
+    except asyncio.TimeoutError:
+        log_app.warning("Очередь вебхуков не отправлена до конца", extra={"pending": WEBHOOK_QUEUE.qsize()})
+
+
+def drain_view() -> dict:
+    # Вызывается из запроса: сам этот запрос не считаем
+    in_flight = max(DRAIN_STATE["in_flight"] - 1, 0)
+    pending_webhooks = WEBHOOK_QUEUE.qsize() + WEBHOOK_STATS["in_progress"]
+    jobs_running = sum(1 for task in JOB_TASKS.values() if not task.done())
+    if DRAIN_STATE["draining"]:
+        status = "draining"
+    else:
+        status = "ok" if DRAIN_STATE["ready"] else "starting"
+    return {
+        "status": status,
+        "handover": DRAIN_STATE["handover"],
+        "draining_since": DRAIN_STATE["since"],
+        "drained": DRAIN_STATE["draining"] and in_flight == 0 and pending_webhooks == 0 and jobs_running == 0,
+        "accounts": len(ACTIVE_CLIENTS),
+        "in_flight": in_flight,
+        "pending_webhooks": pending_webhooks,
+        "jobs_running": jobs_running,
+        "webhooks": {k: v for k, v in WEBHOOK_STATS.items() if k != "in_progress"}
+    }
+
+
+@app.get("/health")
+def health():
+    """Готовность для балансировщика: 200 — принимает трафик, 503 — запускается или передаёт работу"""
+    view = drain_view()
+    return JSONResponse(view, status_code=200 if view["status"] == "ok" else 503)
+
+
+@app.post("/admin/drain")
+def start_drain():
     """
-    client = ACTIVE_CLIENTS.get(req.account)
-    if not client:
-        raise HTTPException(400, detail=f"Аккаунт не найден: {req.account}")
+    Передать работу новому процессу, который уже запущен с тем же ACCOUNTS_FILE
+    и отвечает 200 на /health. Этот процесс перестаёт доставлять входящие и
+    сохранять состояние обновлений, останавливает задания (их продолжит новый
+    процесс с контрольной точки) и доотправляет очередь вебхуков. /health
+    переходит в 503; когда drained=true, процесс можно останавливать.
+
+    Наличие здорового преемника не проверяется: без него входящие перестанут
+    доставляться совсем. Отменить передачу можно через DELETE /admin/drain.
+    """
+    if not DRAIN_STATE["handover"]:
+        DRAIN_STATE.update(draining=True, handover=True, since=datetime.now().isoformat())
+        for task in JOB_TASKS.values():
+            task.cancel()
+        log_app.info("Передача работы новому процессу", extra={"pending_webhooks": WEBHOOK_QUEUE.qsize()})
+    return drain_view()
+
+
+@app.delete("/admin/drain")
+def cancel_drain():
+    """
+    Отменить передачу работы: процесс снова доставляет входящие, сохраняет
+    состояние и продолжает задания с контрольной точки. Вызывать только когда
+    преемник остановлен или так и не стал здоровым — иначе входящие будут
+    доставляться дважды, а файлы состояния писать два процесса.
+    """
+    if DRAIN_STATE["handover"]:
+        DRAIN_STATE.update(draining=False, handover=False, since=None)
+        # Пока шла передача, файлы мог переписать преемник — фиксируем своё состояние
+        save_update_states()
+        save_accounts_file()
+        for name in ACTIVE_CLIENTS:
+            resume_jobs(name)
+        log_app.warning("Передача работы отменена")
+    return drain_view()
+
+
+# ==================== НОВЫЙ ЭНДПОИНТ: Получить информацию об отправителе сообщения ====================
+@app.post("/get_sender_info")
+@admission_controlled("get_sender_info")
+async def get_sender_info(req: GetSenderInfoReq):
+    """
+    Получить информацию об отправителе сообщения по его ID.
+    Возвращает полную информацию о пользователе, который отправил сообщение.
+    """
+    client = get_client(req.account)
 
     try:
         # 1. Получаем сущность чата
-        chat = await client.get_entity(req.chat_id)
+        chat = await resolve_entity(req.account, client, req.chat_id)
         
         # 2. Получаем сообщение по ID
         messages = await client.get_messages(
@@ -468,9 +1847,9 @@ async def get_sender_info(req: GetSenderInfoReq):
         # Если есть ID отправителя, получаем его информацию
         if sender_id:
             try:
-                sender = await client.get_entity(sender_id)
+                sender = await resolve_entity(req.account, client, sender_id)
             except Exception as e:
-                print(f"⚠️ Не удалось получить информацию об отправителе: {e}")
+                log_sender.warning("Не удалось получить информацию об отправителе: %s", e, extra={"sender_id": sender_id})
         
         # Если не удалось получить по ID, пробуем получить из sender
         if not sender and hasattr(message, 'sender'):
@@ -480,53 +1859,9 @@ async def get_sender_info(req: GetSenderInfoReq):
         if not sender:
             raise HTTPException(404, detail="Информация об отправителе не найдена")
         
-        # 4. Формируем информацию об отправителе
-        sender_info = {
-            "id": sender.id,
-            "first_name": getattr(sender, 'first_name', ''),
-            "last_name": getattr(sender, 'last_name', ''),
-            "username": getattr(sender, 'username', None),
-            "phone": getattr(sender, 'phone', None),
-            "is_bot": getattr(sender, 'bot', False),
-            "is_premium": getattr(sender, 'premium', False),
-            "is_verified": getattr(sender, 'verified', False),
-            "is_restricted": getattr(sender, 'restricted', False),
-            "is_scam": getattr(sender, 'scam', False),
-            "is_fake": getattr(sender, 'fake', False),
-            "is_support": getattr(sender, 'support', False),
-            "is_contact": getattr(sender, 'contact', False),
-            "is_deleted": getattr(sender, 'deleted', False),
-            "is_self": getattr(sender, 'self', False),
-            "is_mutual_contact": getattr(sender, 'mutual_contact', False),
-        }
-        
-        # 5. Добавляем информацию о чате (если отправитель - группа или канал)
-        if hasattr(sender, 'title'):
-            sender_info["title"] = sender.title
-            sender_info["is_channel"] = getattr(sender, 'broadcast', False)
-            sender_info["is_group"] = getattr(sender, 'megagroup', False) or getattr(sender, 'gigagroup', False)
-            sender_info["participants_count"] = getattr(sender, 'participants_count', None)
-        
-        # 6. Добавляем статус (онлайн/офлайн)
-        if hasattr(sender, 'status'):
-            status = sender.status
-            if hasattr(status, '__class__'):
-                sender_info["status"] = status.__class__.__name__
-                if hasattr(status, 'was_online'):
-                    sender_info["last_seen"] = status.was_online.isoformat() if status.was_online else None
-                if hasattr(status, 'expires'):
-                    sender_info["status_expires"] = status.expires.isoformat() if status.expires else None
-        
-        # 7. Добавляем информацию о самом сообщении
-        message_info = {
-            "id": message.id,
-            "date": message.date.isoformat() if hasattr(message, 'date') and message.date else None,
-            "text": message.text if hasattr(message, 'text') else message.message if hasattr(message, 'message') else "",
-            "is_outgoing": message.out if hasattr(message, 'out') else False,
-            "is_forward": message.forward if hasattr(message, 'forward') else False,
-            "has_media": bool(message.media) if hasattr(message, 'media') else False,
-            "has_reply": bool(message.reply_to) if hasattr(message, 'reply_to') else False,
-        }
+        # 4. Формируем информацию об отправителе и сообщении
+        sender_info = build_sender_info(sender)
+        message_info = build_message_info(message)
         
         return {
             "status": "success",
@@ -544,7 +1879,7 @@ async def get_sender_info(req: GetSenderInfoReq):
         raise HTTPException(400, detail="Неверный ID чата или пользователя")
     except Exception as e:
         error_msg = str(e)
-        print(f"❌ Ошибка получения информации об отправителе: {error_msg}")
+        log_sender.error("Ошибка получения информации об отправителе: %s", error_msg)
         
         if "MESSAGE_ID_INVALID" in error_msg:
             raise HTTPException(404, detail=f"Сообщение с ID {req.message_id} не найдено в указанном чате")
@@ -556,21 +1891,116 @@ async def get_sender_info(req: GetSenderInfoReq):
             raise HTTPException(500, detail=f"Ошибка получения информации об отправителе: {error_msg}")
 
 
+# ==================== НОВЫЙ ЭНДПОИНТ: Пакетное получение отправителей ====================
+@app.post("/get_sender_info_batch")
+@admission_controlled("get_sender_info_batch")
+async def get_sender_info_batch(req: GetSenderInfoBatchReq):
+    """
+    Получить отправителей сразу для многих сообщений (в том числе из разных чатов).
+    На каждый чат выполняется один запрос GetMessages, отправители берутся
+    из векторов users/chats ответа, без отдельного get_entity на каждое сообщение.
+    """
+    client = get_client(req.account)
+
+    if req.message_ids and req.chat_id is None:
+        raise HTTPException(400, detail="Для message_ids нужно указать chat_id")
+
+    lookups = [(req.chat_id, message_id) for message_id in req.message_ids]
+    lookups += [(item.chat_id, item.message_id) for item in req.items]
+    if not lookups:
+        raise HTTPException(400, detail="Не указаны сообщения")
+    if len(lookups) > SENDER_BATCH_MAX_MESSAGES:
+        raise HTTPException(400, detail=f"Не больше {SENDER_BATCH_MAX_MESSAGES} сообщений за запрос")
+
+    # 1. Группируем ID сообщений по чатам (порядок и дубликаты не важны для запроса)
+    ids_by_chat: Dict[str, List[int]] = {}
+    chat_ids: Dict[str, Union[str, int]] = {}
+    for chat_id, message_id in lookups:
+        key = str(normalize_chat_id(chat_id))
+        chat_ids.setdefault(key, normalize_chat_id(chat_id))
+        ids = ids_by_chat.setdefault(key, [])
+        if message_id not in ids:
+            ids.append(message_id)
+    if len(ids_by_chat) > SENDER_BATCH_MAX_CHATS:
+        raise HTTPException(400, detail=f"Не больше {SENDER_BATCH_MAX_CHATS} чатов за запрос")
+
+    semaphore = asyncio.Semaphore(SENDER_BATCH_CONCURRENCY)
+
+    async def fetch_chat(key: str):
+        # get_input_entity берёт access_hash из кэша сессии, get_messages
+        # с ids=[...] делает один GetMessages (до 100 ID за запрос)
+        async with semaphore:
+            chat = await client.get_input_entity(chat_ids[key])
+            messages = await client.get_messages(chat, ids=ids_by_chat[key])
+        return {m.id: m for m in messages if m is not None}
+
+    # 2. Чаты запрашиваем параллельно, но не больше SENDER_BATCH_CONCURRENCY одновременно
+    keys = list(ids_by_chat)
+    fetched = await asyncio.gather(*(fetch_chat(key) for key in keys), return_exceptions=True)
+    results_by_chat = dict(zip(keys, fetched))
+
+    # 3. Собираем ответ в порядке запроса
+    results = []
+    for chat_id, message_id in lookups:
+        chat_result = results_by_chat[str(normalize_chat_id(chat_id))]
+        item = {"chat_id": chat_id, "message_id": message_id}
+
+        if isinstance(chat_result, Exception):
+            error_msg = str(chat_result)
+            if isinstance(chat_result, PeerIdInvalidError):
+                error_msg = "Неверный ID чата или пользователя"
+            elif "CHANNEL_PRIVATE" in error_msg:
+                error_msg = "Нет доступа к указанному каналу"
+            item.update({"status": "error", "error": error_msg})
+            results.append(item)
+            continue
+
+        message = chat_result.get(message_id)
+        if message is None:
+            item.update({"status": "not_found", "error": f"Сообщение с ID {message_id} не найдено"})
+            results.append(item)
+            continue
+
+        # Отправитель и чат уже заполнены Telethon из users/chats ответа
+        sender = message.sender
+        if sender is None and getattr(message, 'post', False):
+            sender = message.chat
+        chat = message.chat
+        remember_entities(req.account, [sender, chat])
+
+        item.update({
+            "status": "success" if sender else "sender_not_found",
+            "chat_title": getattr(chat, 'title', getattr(chat, 'first_name', 'Unknown')) if chat else "Unknown",
+            "sender": build_sender_info(sender) if sender else None,
+            "message": build_message_info(message),
+        })
+        results.append(item)
+
+    return {
+        "status": "success",
+        "account": req.account,
+        "total": len(results),
+        "found": sum(1 for r in results if r["status"] == "success"),
+        "chats_requested": len(keys),
+        "results": results,
+        "timestamp": datetime.now().isoformat()
+    }
+
+
 # ==================== НОВЫЙ ЭНДПОИНТ: Отправка сообщения новому пользователю ====================
 @app.post("/send_to_new_user")
+@admission_controlled("send_to_new_user")
 async def send_to_new_user(req: SendToNewUserReq):
     """
     Отправить сообщение пользователю, которого нет в контактах.
     Бот автоматически добавит пользователя в контакты, отправит сообщение
     и при необходимости удалит из контактов.
     """
-    client = ACTIVE_CLIENTS.get(req.account)
-    if not client:
-        raise HTTPException(400, detail=f"Аккаунт не найден: {req.account}")
+    client = get_client(req.account)
 
     try:
         # 1. Добавляем пользователя в контакты
-        print(f"📇 Добавляю в контакты: {req.phone}")
+        log_contacts.info("Добавляю в контакты", extra={"phone": req.phone})
         
         contact = InputPhoneContact(
             client_id=0,  # 0 для автоматического ID
@@ -585,20 +2015,23 @@ async def send_to_new_user(req: SendToNewUserReq):
             raise HTTPException(400, detail=f"Пользователь не найден по номеру {req.phone}")
         
         user = result.users[0]
-        print(f"✅ Успешно добавлен! ID: {user.id}, Имя: {user.first_name}")
+        add_to_contacts_index(req.account, result.users, req.phone)
+        log_contacts.info("Контакт добавлен", extra={"user_id": user.id})
         
         # 2. Отправляем сообщение
-        print(f"📤 Отправляю сообщение пользователю {user.id}...")
+        log_send.info("Отправляю сообщение новому пользователю", extra={"user_id": user.id})
         
         try:
             await client.send_message(user, req.message)
-            print(f"✅ Сообщение отправлено!")
+            note_outgoing(req.account, user)
+            log_send.info("Сообщение отправлено", extra={"user_id": user.id})
             
             # 3. Удаляем из контактов если требуется
             if req.delete_after:
-                print(f"🗑️ Удаляю из контактов...")
+                log_contacts.debug("Удаляю из контактов", extra={"user_id": user.id})
                 await client(DeleteContactsRequest(id=[user]))
-                print(f"✅ Удалено из контактов")
+                remove_from_contacts_index(req.account, [user.id])
+                log_contacts.info("Удалено из контактов", extra={"user_id": user.id})
             
             return {
                 "status": "sent",
@@ -615,31 +2048,34 @@ async def send_to_new_user(req: SendToNewUserReq):
             }
             
         except FloodWaitError as e:
-            print(f"⏳ Ограничение Telegram: ждите {e.seconds} секунд")
+            log_send.warning("FloodWait при отправке", extra={"user_id": user.id, "wait_seconds": e.seconds})
             # Удаляем пользователя из контактов, чтобы не оставлять следов
             if not req.delete_after:
                 try:
                     await client(DeleteContactsRequest(id=[user]))
+                    remove_from_contacts_index(req.account, [user.id])
                 except:
                     pass
             raise HTTPException(429, detail=f"Ограничение Telegram: ждите {e.seconds} секунд")
             
         except UserPrivacyRestrictedError:
-            print(f"❌ Пользователь запретил получение сообщений")
+            log_send.warning("Пользователь запретил получение сообщений", extra={"user_id": user.id})
             # Удаляем пользователя из контактов
             if not req.delete_after:
                 try:
                     await client(DeleteContactsRequest(id=[user]))
+                    remove_from_contacts_index(req.account, [user.id])
                 except:
                     pass
             raise HTTPException(403, detail="Пользователь запретил получение сообщений")
             
         except Exception as e:
-            print(f"❌ Ошибка отправки: {e}")
+            log_send.error("Ошибка отправки: %s", e, extra={"user_id": user.id})
             # Удаляем пользователя из контактов в случае ошибки
             if not req.delete_after:
                 try:
                     await client(DeleteContactsRequest(id=[user]))
+                    remove_from_contacts_index(req.account, [user.id])
                 except:
                     pass
             raise HTTPException(500, detail=f"Ошибка отправки сообщения: {str(e)}")
@@ -653,18 +2089,17 @@ async def send_to_new_user(req: SendToNewUserReq):
 
 # ==================== НОВЫЙ ЭНДПОИНТ: Добавить контакт ====================
 @app.post("/add_contact")
+@admission_controlled("add_contact")
 async def add_contact(req: AddContactReq):
     """
     Добавить контакт по номеру телефона.
     Возвращает информацию о добавленном пользователе.
     """
-    client = ACTIVE_CLIENTS.get(req.account)
-    if not client:
-        raise HTTPException(400, detail=f"Аккаунт не найден: {req.account}")
+    client = get_client(req.account)
 
     try:
         # 1. Добавляем пользователя в контакты
-        print(f"📇 Добавляю контакт: {req.phone}")
+        log_contacts.info("Добавляю контакт", extra={"phone": req.phone})
         
         contact = InputPhoneContact(
             client_id=0,  # 0 для автоматического ID
@@ -680,7 +2115,8 @@ async def add_contact(req: AddContactReq):
                                          "Проверьте корректность номера и что пользователь существует в Telegram.")
         
         user = result.users[0]
-        print(f"✅ Контакт успешно добавлен! ID: {user.id}, Имя: {user.first_name}")
+        add_to_contacts_index(req.account, result.users, req.phone)
+        log_contacts.info("Контакт добавлен", extra={"user_id": user.id})
         
         # 2. Получаем полную информацию о пользователе
         user_info = {
@@ -746,22 +2182,21 @@ async def add_contact(req: AddContactReq):
 
 # ==================== НОВЫЙ ЭНДПОИНТ: Отправить контакт (рабочий способ) ====================
 @app.post("/send_contact")
+@admission_controlled("send_contact")
 async def send_contact(req: SendContactReq):
     """
     Отправить контакт как вложение.
     Работает через прямой вызов messages.SendMessageRequest.
     """
-    client = ACTIVE_CLIENTS.get(req.account)
-    if not client:
-        raise HTTPException(400, detail=f"Аккаунт не найден: {req.account}")
+    client = get_client(req.account)
 
     try:
-        print(f"🔍 Получаю информацию о контакте: {req.contact_id}")
+        log_contacts.debug("Получаю информацию о контакте", extra={"contact_id": req.contact_id})
         
         # 1. Получаем информацию о контакте
         try:
             if isinstance(req.contact_id, (str, int)):
-                contact_entity = await client.get_entity(req.contact_id)
+                contact_entity = await resolve_entity(req.account, client, req.contact_id)
             else:
                 contact_entity = req.contact_id
         except Exception as e:
@@ -777,21 +2212,19 @@ async def send_contact(req: SendContactReq):
         contact_last_name = req.last_name or getattr(contact_entity, 'last_name', '')
         contact_phone = req.phone or getattr(contact_entity, 'phone', '')
         
-        # 3. Если нет телефона, ищем в списке контактов
+        # 3. Если нет телефона, ищем в индексе контактов
         if not contact_phone:
             try:
-                contacts = await client.get_contacts()
-                for contact in contacts:
-                    if contact.id == contact_id:
-                        contact_phone = getattr(contact, 'phone', '')
-                        # Если не указаны имя/фамилия, берем из контакта
-                        if not contact_first_name:
-                            contact_first_name = getattr(contact, 'first_name', 'Контакт')
-                        if not contact_last_name:
-                            contact_last_name = getattr(contact, 'last_name', '')
-                        break
+                contact = await find_contact(req.account, client, contact_id)
+                if contact:
+                    contact_phone = contact["phone"]
+                    # Если не указаны имя/фамилия, берем из контакта
+                    if not contact_first_name:
+                        contact_first_name = contact["first_name"] or 'Контакт'
+                    if not contact_last_name:
+                        contact_last_name = contact["last_name"]
             except Exception as e:
-                print(f"⚠️ Ошибка при получении списка контактов: {e}")
+                log_contacts.warning("Ошибка при получении индекса контактов: %s", e)
         
         # 4. Проверяем обязательные поля
         if not contact_phone:
@@ -801,11 +2234,11 @@ async def send_contact(req: SendContactReq):
         if not contact_first_name:
             contact_first_name = "Контакт"
         
-        print(f"📤 Отправляю контакт: {contact_first_name} {contact_last_name} ({contact_phone})")
+        log_send.info("Отправляю контакт", extra={"contact_id": contact_id, "chat_id": req.chat_id})
         
         # 5. Получаем сущность чата для отправки
         try:
-            chat_entity = await client.get_entity(req.chat_id)
+            chat_entity = await resolve_entity(req.account, client, req.chat_id)
         except Exception as e:
             raise HTTPException(400, detail=f"Не удалось найти чат: {str(e)}")
         
@@ -829,6 +2262,7 @@ async def send_contact(req: SendContactReq):
             schedule_date=None,
             send_as=None
         ))
+        note_outgoing(req.account, chat_entity)
         
         # 8. Получаем ID отправленного сообщения
         message_id = None
@@ -840,7 +2274,7 @@ async def send_contact(req: SendContactReq):
         elif hasattr(result, 'id'):
             message_id = result.id
         
-        print(f"✅ Контакт успешно отправлен! ID сообщения: {message_id}")
+        log_send.info("Контакт отправлен", extra={"message_id": message_id})
         
         return {
             "status": "success",
@@ -870,7 +2304,7 @@ async def send_contact(req: SendContactReq):
         raise HTTPException(429, detail=f"Ограничение Telegram: подождите {e.seconds} секунд")
     except Exception as e:
         error_msg = str(e)
-        print(f"❌ Ошибка отправки контакта: {error_msg}")
+        log_send.error("Ошибка отправки контакта: %s", error_msg)
         
         # Обработка специфических ошибок
         if "PHONE_NUMBER_INVALID" in error_msg:
@@ -887,50 +2321,64 @@ async def send_contact(req: SendContactReq):
 
 # ==================== НОВЫЙ ЭНДПОИНТ: Отправить контакт (самый простой способ) ====================
 @app.post("/send_contact_simple")
+@admission_controlled("send_contact_simple")
 async def send_contact_simple(req: SendContactReq):
     """
     Самый простой способ отправить контакт.
     Требует явного указания телефона, имени и фамилии.
     """
-    client = ACTIVE_CLIENTS.get(req.account)
-    if not client:
-        raise HTTPException(400, detail=f"Аккаунт не найден: {req.account}")
+    client = get_client(req.account)
 
     try:
-        # 1. Проверяем обязательные поля
-        if not req.phone:
+        phone = req.phone
+        first_name = req.first_name
+        last_name = req.last_name
+        
+        # 1. Если телефон не указан, берем его из индекса контактов по contact_id
+        if not phone:
+            contact_id = normalize_chat_id(req.contact_id)
+            if isinstance(contact_id, int):
+                contact = await find_contact(req.account, client, contact_id)
+                if contact:
+                    phone = contact["phone"]
+                    first_name = first_name or contact["first_name"]
+                    last_name = last_name or contact["last_name"]
+        
+        # 2. Проверяем обязательные поля
+        if not phone:
             raise HTTPException(400, detail="Параметр 'phone' обязателен")
-        if not req.first_name:
+        if not first_name:
             raise HTTPException(400, detail="Параметр 'first_name' обязателен")
         
-        # 2. Получаем сущность чата
-        chat_entity = await client.get_entity(req.chat_id)
+        # 3. Получаем сущность чата
+        chat_entity = await resolve_entity(req.account, client, req.chat_id)
         
-        # 3. Создаем InputMediaContact
+        # 4. Создаем InputMediaContact
         from telethon.tl.types import InputMediaContact
         
         media_contact = InputMediaContact(
-            phone_number=req.phone,
-            first_name=req.first_name,
-            last_name=req.last_name,
+            phone_number=phone,
+            first_name=first_name,
+            last_name=last_name,
             vcard=''
         )
         
-        # 4. Отправляем сообщение
+        # 5. Отправляем сообщение
         result = await client.send_message(
             entity=chat_entity,
             message=req.message if req.message else "",
             file=media_contact
         )
+        note_outgoing(req.account, chat_entity)
         
         return {
             "status": "success",
             "account": req.account,
             "chat_id": req.chat_id,
             "contact": {
-                "phone": req.phone,
-                "first_name": req.first_name,
-                "last_name": req.last_name
+                "phone": phone,
+                "first_name": first_name,
+                "last_name": last_name
             },
             "message": {
                 "id": result.id,
@@ -938,10 +2386,538 @@ async def send_contact_simple(req: SendContactReq):
             }
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         error_msg = str(e)
         raise HTTPException(500, detail=f"Ошибка отправки контакта: {error_msg}")
    
+# ==================== Поток событий: SSE и WebSocket ====================
+class EventSubscriber:
+    """Подписчик на поток входящих сообщений со своими фильтрами и очередью"""
+
+    def __init__(self, accounts: Optional[set], chat_ids: Optional[set], policy: str):
+        self.accounts = accounts
+        self.chat_ids = chat_ids
+        self.policy = policy  # "disconnect" или "drop_oldest"
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.closed = False
+        self.dropped = 0
+
+    def matches(self, account: str, chat_id) -> bool:
+        if self.accounts is not None and account not in self.accounts:
+            return False
+        if self.chat_ids is not None and chat_id not in self.chat_ids:
+            return False
+        return True
+
+    def push(self, event: tuple):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(event)
+            return
+        except asyncio.QueueFull:
+            pass
+
+        if self.policy == "drop_oldest":
+            self.queue.get_nowait()
+            self.queue.put_nowait(event)
+            self.dropped += 1
+        else:
+            # Медленный потребитель: очищаем очередь и будим его сигналом закрытия
+            self.closed = True
+            EVENT_SUBSCRIBERS.discard(self)
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+# Кольцевой буфер: (event_id, account, chat_id, json-строка payload)
+EVENT_BUFFER: deque = deque(maxlen=EVENT_BUFFER_SIZE)
+EVENT_SUBSCRIBERS: set = set()
+EVENT_LAST_ID = 0
+
+
+def publish_event(payload: dict):
+    """Разослать payload входящего сообщения всем подходящим подписчикам"""
+    global EVENT_LAST_ID
+    EVENT_LAST_ID += 1
+    # Сериализуем один раз на событие, а не на каждого подписчика
+    event = (EVENT_LAST_ID, payload.get("from_account"), payload.get("chat_id"), json.dumps(payload, ensure_ascii=False))
+    EVENT_BUFFER.append(event)
+
+    for subscriber in list(EVENT_SUBSCRIBERS):
+        if subscriber.matches(event[1], event[2]):
+            subscriber.push(event)
+
+
+def parse_csv_param(value: Optional[str], cast=str) -> Optional[set]:
+    if not value:
+        return None
+    return {cast(item.strip()) for item in value.split(",") if item.strip()}
+
+
+def make_subscriber(accounts: Optional[str], chat_ids: Optional[str], policy: str) -> EventSubscriber:
+    """Проверить параметры подписки и создать подписчика (ещё не зарегистрированного)"""
+    if policy not in ("disconnect", "drop_oldest"):
+        raise HTTPException(400, detail="policy должен быть 'disconnect' или 'drop_oldest'")
+    try:
+        return EventSubscriber(parse_csv_param(accounts), parse_csv_param(chat_ids, int), policy)
+    except ValueError:
+        raise HTTPException(400, detail="chat_ids должен содержать числовые ID через запятую")
+
+
+def subscribe_events(subscriber: EventSubscriber, last_event_id: Optional[int]):
+    """
+    Зарегистрировать подписчика и вернуть список событий для повтора и флаг gap —
+    True, если last_event_id уже вытеснен из буфера (часть событий потеряна).
+    Вызывается там, где дальше гарантированно выполнится EVENT_SUBSCRIBERS.discard.
+    """
+    # Подписываемся до чтения буфера, чтобы не потерять события между ними
+    EVENT_SUBSCRIBERS.add(subscriber)
+
+    replay = []
+    gap = False
+    if last_event_id is not None:
+        gap = bool(EVENT_BUFFER) and EVENT_BUFFER[0][0] > last_event_id + 1
+        replay = [e for e in EVENT_BUFFER if e[0] > last_event_id and subscriber.matches(e[1], e[2])]
+    return replay, gap
+
+
+async def next_events(subscriber: EventSubscriber, replay: list):
+    """
+    Асинхронный генератор событий подписчика: сначала повтор из буфера, затем живые.
+    Отдаёт None как heartbeat, если событий не было EVENT_HEARTBEAT_SECONDS.
+    """
+    last_sent = 0
+    for event in replay:
+        last_sent = event[0]
+        yield event
+
+    while not subscriber.closed:
+        try:
+            event = await asyncio.wait_for(subscriber.queue.get(), timeout=EVENT_HEARTBEAT_SECONDS)
+        except asyncio.TimeoutError:
+            yield None
+            continue
+        if event is None:
+            break
+        # События, попавшие и в повтор, и в живую очередь, не дублируем
+        if event[0] <= last_sent:
+            continue
+        last_sent = event[0]
+        yield event
+
+
+@app.get("/events/stream")
+async def events_stream(request: Request, accounts: Optional[str] = None, chat_ids: Optional[str] = None,
+                        policy: str = "disconnect", last_event_id: Optional[int] = None):
+    """
+    Server-Sent Events поток входящих сообщений.
+    Фильтры: accounts и chat_ids через запятую. Возобновление — по заголовку
+    Last-Event-ID (или параметру last_event_id) из кольцевого буфера.
+    """
+    header_id = request.headers.get("last-event-id")
+    if header_id and header_id.isdigit():
+        last_event_id = int(header_id)
+
+    subscriber = make_subscriber(accounts, chat_ids, policy)
+
+    async def stream():
+        # Регистрируемся только внутри генератора: если ответ так и не начнёт
+        # отдаваться, подписчик не останется висеть в EVENT_SUBSCRIBERS
+        replay, gap = subscribe_events(subscriber, last_event_id)
+        try:
+            yield "retry: 3000\n\n"
+            if gap:
+                yield f"event: gap\ndata: {json.dumps({'oldest_event_id': EVENT_BUFFER[0][0]})}\n\n"
+            async for event in next_events(subscriber, replay):
+                if event is None:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+                    continue
+                yield f"id: {event[0]}\nevent: message\ndata: {event[3]}\n\n"
+            if subscriber.closed:
+                yield "event: overflow\ndata: {}\n\n"
+        finally:
+            EVENT_SUBSCRIBERS.discard(subscriber)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.websocket("/events/ws")
+async def events_websocket(websocket: WebSocket, accounts: Optional[str] = None, chat_ids: Optional[str] = None,
+                           policy: str = "disconnect", last_event_id: Optional[int] = None):
+    """WebSocket-аналог /events/stream: каждое событие — JSON {"id": ..., "event": {...}}"""
+    try:
+        subscriber = make_subscriber(accounts, chat_ids, policy)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=str(e.detail))
+        return
+
+    await websocket.accept()
+    replay, gap = subscribe_events(subscriber, last_event_id)
+    try:
+        if gap:
+            await websocket.send_text(json.dumps({"type": "gap", "oldest_event_id": EVENT_BUFFER[0][0]}))
+        async for event in next_events(subscriber, replay):
+            if event is None:
+                await websocket.send_text('{"type": "ping"}')
+                continue
+            await websocket.send_text(f'{{"type": "message", "id": {event[0]}, "event": {event[3]}}}')
+        if subscriber.closed:
+            await websocket.close(code=1013, reason="slow consumer")
+    except WebSocketDisconnect:
+        pass
+    finally:
+        EVENT_SUBSCRIBERS.discard(subscriber)
+
+
+@app.get("/events/stats")
+def events_stats():
+    return {
+        "subscribers": len(EVENT_SUBSCRIBERS),
+        "last_event_id": EVENT_LAST_ID,
+        "buffered": len(EVENT_BUFFER),
+        "oldest_event_id": EVENT_BUFFER[0][0] if EVENT_BUFFER else None,
+        "dropped": sum(sub.dropped for sub in EVENT_SUBSCRIBERS)
+    }
+
+
+# ==================== Догон пропущенных обновлений ====================
+def load_update_states() -> Dict[str, dict]:
+    try:
+        with open(UPDATE_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log_updates.error("Ошибка чтения %s: %s", UPDATE_STATE_FILE, e)
+        return {}
+
+
+def save_update_states():
+    if DRAIN_STATE["handover"]:
+        # Файл уже ведёт новый процесс: старое состояние откатило бы его назад
+        return
+    # Пишем во временный файл и атомарно подменяем, чтобы не получить обрезанный JSON
+    tmp_path = f"{UPDATE_STATE_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(UPDATE_STATES, f)
+        os.replace(tmp_path, UPDATE_STATE_FILE)
+    except Exception as e:
+        log_updates.error("Ошибка сохранения %s: %s", UPDATE_STATE_FILE, e)
+
+
+def remember_delivery(account: str, chat_id: int, message_id: int) -> bool:
+    """Отметить сообщение доставленным. False — если оно уже доставлялось (живой поток и догон пересеклись)"""
+    seen, order = RECENT_DELIVERIES.setdefault(account, (set(), deque()))
+    key = (chat_id, message_id)
+    if key in seen:
+        return False
+    seen.add(key)
+    order.append(key)
+    if len(order) > RECENT_DELIVERIES_SIZE:
+        seen.discard(order.popleft())
+    return True
+
+
+async def snapshot_update_state(account: str, client: TelegramClient):
+    """Запомнить текущие pts/qts/date/seq аккаунта (один дешёвый GetState)"""
+    state = await client(functions.updates.GetStateRequest())
+    account_state = UPDATE_STATES.setdefault(account, {})
+    account_state.update({
+        "pts": state.pts,
+        "qts": state.qts,
+        "date": int(state.date.timestamp()),
+        "seq": state.seq,
+    })
+
+
+async def snapshot_all_update_states():
+    for name, client in list(ACTIVE_CLIENTS.items()):
+        if not client.is_connected():
+            continue
+        try:
+            await snapshot_update_state(name, client)
+        except Exception as e:
+            log_updates.warning("Ошибка получения состояния обновлений: %s", e, extra={"account": name})
+    save_update_states()
+
+
+async def update_state_saver():
+    """
+    Периодически сохраняет состояние обновлений всех аккаунтов.
+    Разрыв соединения догоняет сам Telethon (GetDifference в автопереподключении):
+    is_connected() остаётся True всё это время, поэтому наш догон с
+    ограничением CATCH_UP_RATE выполняется только при старте процесса.
+    """
+    last_snapshot = time.monotonic()
+    while True:
+        await asyncio.sleep(5)
+        if time.monotonic() - last_snapshot >= UPDATE_STATE_SAVE_INTERVAL:
+            last_snapshot = time.monotonic()
+            # Пока идёт догон, старое состояние не перезаписываем — иначе рестарт потеряет хвост
+            catching_up = {name for name, task in CATCH_UP_TASKS.items() if not task.done()}
+            for name, client in list(ACTIVE_CLIENTS.items()):
+                if name in catching_up or not client.is_connected():
+                    continue
+                try:
+                    await snapshot_update_state(name, client)
+                except Exception as e:
+                    log_updates.warning("Ошибка получения состояния обновлений: %s", e, extra={"account": name})
+            save_update_states()
+
+
+def start_catch_up(account: str, client: TelegramClient):
+    if not CATCH_UP_ENABLED or "pts" not in UPDATE_STATES.get(account, {}):
+        return
+    task = CATCH_UP_TASKS.get(account)
+    if task and not task.done():
+        return
+    CATCH_UP_TASKS[account] = asyncio.create_task(catch_up(account, client))
+
+
+async def catch_up(account: str, client: TelegramClient):
+    """
+    Получить разницу обновлений с сохранённого состояния и прогнать
+    пропущенные сообщения через обычный путь доставки, по порядку и
+    не быстрее CATCH_UP_RATE сообщений в секунду.
+    """
+    state = dict(UPDATE_STATES[account])
+    pts, qts, date = state["pts"], state["qts"], datetime.fromtimestamp(state["date"])
+    delivered = 0
+    too_long_channels = []
+
+    try:
+        while True:
+            diff = await client(functions.updates.GetDifferenceRequest(pts=pts, date=date, qts=qts))
+
+            if isinstance(diff, types.updates.DifferenceEmpty):
+                break
+            if isinstance(diff, types.updates.DifferenceTooLong):
+                # Сервер не отдаст разрыв целиком — продолжаем с его pts, остаток потерян
+                log_updates.warning("Разрыв обновлений слишком большой, часть сообщений не догнать", extra={"account": account})
+                pts = diff.pts
+                continue
+
+            entities = {utils.get_peer_id(e): e for e in [*diff.users, *diff.chats]}
+            messages = list(diff.new_messages)
+            for update in diff.other_updates:
+                if isinstance(update, (types.UpdateNewChannelMessage, types.UpdateNewMessage)):
+                    messages.append(update.message)
+                elif isinstance(update, types.UpdateChannelTooLong):
+                    too_long_channels.append(update.channel_id)
+
+            messages = [m for m in messages if isinstance(m, types.Message) and not m.out]
+            messages.sort(key=lambda m: (m.date, m.id))
+            for message in messages:
+                # Так же, как Telethon делает для событий: привязываем клиента и сущности.
+                # _finish_init — приватный API Telethon 1.x, при обновлении библиотеки проверить
+                message._finish_init(client, entities, None)
+                deliver_incoming(account, message, catch_up=True)
+                delivered += 1
+                await asyncio.sleep(1 / CATCH_UP_RATE)
+
+            is_slice = isinstance(diff, types.updates.DifferenceSlice)
+            new_state = diff.intermediate_state if is_slice else diff.state
+            pts, qts, date = new_state.pts, new_state.qts, new_state.date
+            if not is_slice:
+                break
+
+        # Каналы с собственным pts: догоняем историей от последнего доставленного ID
+        channels = state.get("channels", {})
+        for channel_id in too_long_channels:
+            chat_id = utils.get_peer_id(PeerChannel(channel_id))
+            min_id = channels.get(str(chat_id))
+            if not min_id:
+                continue
+            messages = [m async for m in client.iter_messages(chat_id, min_id=min_id, limit=CATCH_UP_CHANNEL_LIMIT)]
+            for message in reversed(messages):
+                if message.out:
+                    continue
+                deliver_incoming(account, message, catch_up=True)
+                delivered += 1
+                await asyncio.sleep(1 / CATCH_UP_RATE)
+
+        UPDATE_STATES[account].update({"pts": pts, "qts": qts, "date": int(date.timestamp())})
+        save_update_states()
+        log_updates.info("Догон завершён", extra={"account": account, "delivered": delivered})
+    except Exception as e:
+        log_updates.error("Ошибка догона обновлений: %s", e, extra={"account": account})
+
+
+# ==================== Дедупликация между аккаунтами ====================
+def dedup_first_sighting(chat_id: int, message_id: int, account: str) -> bool:
+    """
+    True — если это первое появление сообщения среди всех аккаунтов и его нужно доставить.
+    Ключ (chat_id, message_id) однозначен только для каналов и супергрупп: в обычных
+    группах ID сообщений у каждого аккаунта свои, поэтому они сюда не попадают.
+    Окно ограничено по времени и числу записей, проверка — O(1).
+    """
+    now = time.monotonic()
+    # Записи добавляются по времени, поэтому устаревшие всегда в начале
+    while DEDUP_SEEN:
+        oldest = next(iter(DEDUP_SEEN.values()))
+        if now - oldest["first_seen"] < DEDUP_WINDOW_SECONDS and len(DEDUP_SEEN) < DEDUP_MAX_ENTRIES:
+            break
+        DEDUP_SEEN.popitem(last=False)
+
+    key = (chat_id, message_id)
+    entry = DEDUP_SEEN.get(key)
+    if entry is not None:
+        if account not in entry["seen_by"]:
+            entry["seen_by"].append(account)
+        DEDUP_STATS["suppressed"] += 1
+        return False
+
+    DEDUP_SEEN[key] = {"first_seen": now, "delivered_by": account, "seen_by": [account]}
+    DEDUP_STATS["delivered"] += 1
+    return True
+
+
+@app.get("/dedup/stats")
+def dedup_stats():
+    return {
+        "enabled": DEDUP_ENABLED,
+        "window_seconds": DEDUP_WINDOW_SECONDS,
+        "entries": len(DEDUP_SEEN),
+        "max_entries": DEDUP_MAX_ENTRIES,
+        **DEDUP_STATS
+    }
+
+
+@app.get("/dedup/{chat_id}/{message_id}")
+def dedup_lookup(chat_id: int, message_id: int):
+    """Какие аккаунты видели сообщение и через какой оно было доставлено"""
+    entry = DEDUP_SEEN.get((chat_id, message_id))
+    if not entry:
+        raise HTTPException(404, detail="Сообщение не найдено в окне дедупликации")
+    return {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "delivered_by": entry["delivered_by"],
+        "seen_by": entry["seen_by"]
+    }
+
+
+@app.get("/debug/loop")
+def debug_loop():
+    """Статистика задержек event loop (зависания дольше LOOP_STALL_THRESHOLD)"""
+    return {
+        "interval_seconds": LOOP_MONITOR_INTERVAL,
+        "stall_threshold_ms": LOOP_STALL_THRESHOLD * 1000,
+        "cpu_workers": CPU_WORKERS,
+        **LOOP_STATS
+    }
+
+
+PROFILE_LOCK = asyncio.Lock()
+
+
+@app.get("/debug/profile")
+async def debug_profile(seconds: float = 5, interval_ms: float = 10, memory: bool = True,
+                        all_threads: bool = False, format: str = "json"):
+    """
+    Профиль за seconds секунд: сэмплы стеков в формате collapsed stacks
+    (flamegraph.pl, speedscope) и, при memory=true, топ мест аллокаций
+    tracemalloc, переживших окно профилирования. По умолчанию снимается только
+    поток event loop; all_threads=true добавляет пул потоков и служебные потоки.
+    format=collapsed отдаёт только стеки текстом.
+    """
+    if format not in ("json", "collapsed"):
+        raise HTTPException(400, detail="format должен быть json или collapsed")
+    if PROFILE_LOCK.locked():
+        raise HTTPException(409, detail="Профилирование уже выполняется")
+
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    interval = max(interval_ms, 1) / 1000
+    thread_ids = None if all_threads else {threading.get_ident()}
+
+    async with PROFILE_LOCK:
+        started_tracing = memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        try:
+            samples, counts = await asyncio.to_thread(sample_stacks, seconds, interval, thread_ids)
+            snapshot = await asyncio.to_thread(tracemalloc.take_snapshot) if memory else None
+            traced = tracemalloc.get_traced_memory() if memory else None
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+
+    collapsed = [f"{stack} {count}" for stack, count in sorted(counts.items(), key=lambda item: -item[1])]
+    log_loop.info("Профиль снят", extra={"seconds": seconds, "samples": samples, "stacks": len(counts)})
+    if format == "collapsed":
+        return Response(content="\n".join(collapsed) + "\n", media_type="text/plain")
+
+    result = {"seconds": seconds, "interval_ms": interval * 1000, "samples": samples, "collapsed": collapsed}
+    if snapshot is not None:
+        result["memory"] = {
+            "traced_current_kb": round(traced[0] / 1024, 1),
+            "traced_peak_kb": round(traced[1] / 1024, 1),
+            "top": [
+                {"location": str(stat.traceback[0]), "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:PROFILE_MEMORY_TOP]
+            ]
+        }
+    return result
+
+
+@app.get("/metrics/single_flight")
+def single_flight_metrics():
+    """Сколько вызовов пришло и сколько реально ушло в Telegram по видам запросов"""
+    kinds = {}
+    for kind, stats in SINGLE_FLIGHT_STATS.items():
+        kinds[kind] = {
+            **stats,
+            "coalesced": stats["calls"] - stats["executions"],
+            "coalescing_ratio": round(stats["calls"] / stats["executions"], 3) if stats["executions"] else None
+        }
+    return {"in_flight": len(SINGLE_FLIGHT), "kinds": kinds}
+
+
+@app.get("/metrics/logging")
+def logging_metrics():
+    """Очередь логов: сколько записей ждёт фонового потока и сколько отброшено при переполнении"""
+    return {
+        "queue_size": LOG_LISTENER.queue.qsize(),
+        "queue_limit": LOG_QUEUE_SIZE,
+        "dropped": gateway_log_handler().dropped
+    }
+
+
+@app.get("/metrics/admission")
+def admission_metrics():
+    """Заполненность лимитов: активные, ожидающие, пропущенные и отклонённые запросы"""
+    gates = [
+        {
+            "account": account,
+            "scope": route or "account",
+            "limit": gate.limit,
+            "active": gate.active,
+            "waiting": gate.waiting,
+            "admitted": gate.admitted,
+            "rejected": gate.rejected
+        }
+        for (account, route), gate in ADMISSION_GATES.items()
+    ]
+    return {
+        "account_concurrency": ACCOUNT_CONCURRENCY,
+        "route_limits": ROUTE_LIMITS,
+        "queue_size": ADMISSION_QUEUE_SIZE,
+        "wait_timeout_seconds": ADMISSION_WAIT_TIMEOUT,
+        "gates": gates
+    }
+
+
 # ==================== Остальные эндпоинты (без изменений) ====================
 async def incoming_handler(event):
     if event.is_outgoing:
@@ -953,152 +2929,195 @@ async def incoming_handler(event):
             from_account = name
             break
 
+    deliver_incoming(from_account, event.message)
+
+
+def deliver_incoming(account: str, message, catch_up: bool = False):
+    """Общий путь доставки входящего сообщения: payload → поток событий → вебхук"""
+    if DRAIN_STATE["handover"]:
+        # Входящие уже доставляет новый процесс
+        return
+    if not remember_delivery(account, message.chat_id, message.id):
+        return
+
     payload = {
-        "from_account": from_account,
-        "sender_id": event.sender_id,
-        "chat_id": event.chat_id,
-        "message_id": event.id,
-        "text": event.text or "",
-        "date": event.date.isoformat() if event.date else None,
+        "from_account": account,
+        "sender_id": message.sender_id,
+        "chat_id": message.chat_id,
+        "message_id": message.id,
+        "text": message.text or "",
+        "date": message.date.isoformat() if message.date else None,
     }
+    if catch_up:
+        payload["catch_up"] = True
+
+    if isinstance(message.peer_id, types.PeerChannel):
+        channels = UPDATE_STATES.setdefault(account, {}).setdefault("channels", {})
+        channels[str(message.chat_id)] = max(message.id, channels.get(str(message.chat_id), 0))
+
+    if DEDUP_ENABLED and isinstance(message.peer_id, types.PeerChannel):
+        if not dedup_first_sighting(message.chat_id, message.id, account):
+            return
+
+    if WEBHOOK_ENRICH_FIELDS:
+        enrich_payload(payload, account, message)
+
+    # Сначала подписчикам потока (без сетевых задержек), затем вебхук
+    publish_event(payload)
+
+    log_incoming.info("Входящее сообщение", extra={
+        "account": account, "chat_id": payload["chat_id"], "message_id": payload["message_id"]
+    })
 
     if WEBHOOK_URL:
-        try:
-            requests.post(WEBHOOK_URL, json=payload, timeout=12)
-        except:
-            pass
+        enqueue_webhook(payload)
 
 
 @app.post("/send")
+@admission_controlled("send")
 async def send_message(req: SendMessageReq):
-    client = ACTIVE_CLIENTS.get(req.account)
-    if not client:
-        raise HTTPException(400, detail=f"Аккаунт не найден: {req.account}")
+    client = get_client(req.account)
 
     try:
-        await client.send_message(req.chat_id, req.text)
+        sent = await client.send_message(req.chat_id, req.text)
+        note_outgoing(req.account, sent.peer_id)
         return {"status": "sent", "from": req.account, "to": req.chat_id}
     except Exception as e:
         raise HTTPException(500, detail=f"Ошибка отправки: {str(e)}")
 
 
 @app.post("/export_members")
+@admission_controlled("export_members")
 async def export_members(req: ExportMembersReq):
-    client = ACTIVE_CLIENTS.get(req.account)
-    if not client:
-        raise HTTPException(400, detail=f"Аккаунт не найден: {req.account}")
+    client = get_client(req.account)
+
+    if req.format not in ("objects", "columnar"):
+        raise HTTPException(400, detail="format должен быть 'objects' или 'columnar'")
 
     try:
-        group = await client.get_entity(req.group)
-        participants = await client.get_participants(group, aggressive=True)
-
-        members = []
-        for p in participants:
-            # Определяем, является ли участник администратором
-            is_admin = False
-            admin_title = None
-            
-            # Проверяем разные способы определения администратора
-            if hasattr(p, 'participant'):
-                # Для участников групп/каналов
-                participant = p.participant
-                if hasattr(participant, 'admin_rights') and participant.admin_rights:
-                    is_admin = True
-                    admin_title = getattr(participant, 'rank', None) or getattr(participant, 'title', None)
-            
-            # Альтернативная проверка через права
-            if not is_admin and hasattr(p, 'admin_rights') and p.admin_rights:
-                is_admin = True
-            
-            # Собираем информацию об участнике
-            member_data = {
-                "id": p.id,
-                "username": p.username if hasattr(p, 'username') and p.username else None,
-                "first_name": p.first_name if hasattr(p, 'first_name') and p.first_name else "",
-                "last_name": p.last_name if hasattr(p, 'last_name') and p.last_name else "",
-                "phone": p.phone if hasattr(p, 'phone') and p.phone else None,
-                "is_admin": is_admin,
-                "admin_title": admin_title,
-                "is_bot": p.bot if hasattr(p, 'bot') else False,
-                "is_self": p.self if hasattr(p, 'self') else False,
-                "is_contact": p.contact if hasattr(p, 'contact') else False,
-                "is_mutual_contact": p.mutual_contact if hasattr(p, 'mutual_contact') else False,
-                "is_deleted": p.deleted if hasattr(p, 'deleted') else False,
-                "is_verified": p.verified if hasattr(p, 'verified') else False,
-                "is_restricted": p.restricted if hasattr(p, 'restricted') else False,
-                "is_scam": p.scam if hasattr(p, 'scam') else False,
-                "is_fake": p.fake if hasattr(p, 'fake') else False,
-                "is_support": p.support if hasattr(p, 'support') else False,
-                "is_premium": p.premium if hasattr(p, 'premium') else False,
-            }
-            
-            # Добавляем статус (онлайн/офлайн)
-            if hasattr(p, 'status'):
-                status = p.status
-                if hasattr(status, '__class__'):
-                    member_data["status"] = status.__class__.__name__
-                    if hasattr(status, 'was_online'):
-                        member_data["last_seen"] = status.was_online.isoformat() if status.was_online else None
-            
-            members.append(member_data)
+        group = await resolve_entity(req.account, client, req.group)
+        # Участников сворачиваем в MemberRecord по мере прихода страниц, не держа весь
+        # список объектов Telethon; преобразование — в пуле потоков порциями
+        records, pending = [], []
+        async for participant in client.iter_participants(group, aggressive=True):
+            pending.append(participant)
+            if len(pending) >= CPU_CHUNK_SIZE:
+                records.extend(await map_in_executor(build_member_record, pending))
+                pending = []
+        records.extend(await map_in_executor(build_member_record, pending))
 
-        return {
+        result = {
             "status": "exported",
             "group": req.group,
             "group_title": group.title if hasattr(group, 'title') else "Unknown",
-            "total_members": len(members),
-            "admins_count": sum(1 for m in members if m["is_admin"]),
-            "bots_count": sum(1 for m in members if m["is_bot"]),
-            "members": members
+            "total_members": len(records),
+            "admins_count": sum(1 for r in records if r.flags & 1),
+            "bots_count": sum(1 for r in records if r.flags & 2),
         }
+
+        if req.format == "columnar":
+            result.update({
+                "format": "columnar",
+                "columns": MEMBER_COLUMNS,
+                "flag_bits": MEMBER_FLAGS,
+                "rows": await map_in_executor(MemberRecord.to_row, records),
+            })
+        else:
+            result["members"] = await map_in_executor(MemberRecord.to_dict, records)
+
+        return await json_response_in_executor(result)
     except Exception as e:
-        print(f"Ошибка экспорта участников: {e}")
+        log_export.error("Ошибка экспорта участников: %s", e)
         raise HTTPException(500, detail=f"Ошибка экспорта: {str(e)}")
 
 
-@app.post("/dialogs")
-async def get_dialogs(req: GetDialogsReq):
-    client = ACTIVE_CLIENTS.get(req.account)
-    if not client:
-        raise HTTPException(400, detail=f"Аккаунт не найден: {req.account}")
+async def load_dialog_infos(account: str, client: TelegramClient, limit: int, include_folders: bool,
+                            include_preview: bool = False) -> List[DialogInfo]:
+    if include_folders:
+        return await get_dialogs_with_folders_info(account, client, limit, include_preview)
+    dialogs = await fetch_dialogs(account, client, limit)
+    return await dialogs_to_info(dialogs, include_preview=include_preview)
 
-    try:
-        if req.include_folders:
-            dialog_list = await get_dialogs_with_folders_info(client, req.limit)
-        else:
-            dialogs = await client.get_dialogs(limit=req.limit)
-            dialog_list = [
-                DialogInfo(
-                    id=dialog.entity.id,
-                    title=dialog.title or dialog.name or "Без названия",
-                    username=getattr(dialog.entity, 'username', None),
-                    folder_names=[],
-                    is_group=getattr(dialog.entity, 'megagroup', False) or getattr(dialog.entity, 'gigagroup', False),
-                    is_channel=getattr(dialog.entity, 'broadcast', False),
-                    is_user=hasattr(dialog.entity, 'first_name'),
-                    unread_count=dialog.unread_count,
-                    last_message_date=dialog.date.isoformat() if dialog.date else None
-                ) for dialog in dialogs
-            ]
-        
+
+async def dialogs_response(request: Request, account: str, limit: int, include_folders: bool,
+                           include_preview: bool = False) -> Response:
+    client = get_client(account)
+
+    async def build():
+        dialog_list = await load_dialog_infos(account, client, limit, include_folders, include_preview)
         return {
             "status": "success",
-            "account": req.account,
+            "account": account,
             "total_dialogs": len(dialog_list),
             "dialogs": dialog_list
         }
+
+    try:
+        return await conditional_json(
+            request, (account, "dialogs", limit, include_folders, include_preview), get_version(account, "dialogs"), build
+        )
     except Exception as e:
         raise HTTPException(500, detail=f"Ошибка получения диалогов: {str(e)}")
 
 
-@app.post("/folders/{account}")
-async def get_all_folders(account: str):
-    client = ACTIVE_CLIENTS.get(account)
-    if not client:
-        raise HTTPException(400, detail=f"Аккаунт не найден: {account}")
+@app.post("/dialogs")
+@admission_controlled("dialogs")
+async def get_dialogs(req: GetDialogsReq, request: Request):
+    return await dialogs_response(request, req.account, req.limit, req.include_folders, req.include_preview)
 
-    try:
-        dialog_filters_result = await client(GetDialogFiltersRequest())
+
+@app.get("/dialogs")
+@admission_controlled("dialogs")
+async def get_dialogs_conditional(request: Request, account: str, limit: int = 50, include_folders: bool = True,
+                                  include_preview: bool = False):
+    """GET-вариант /dialogs с поддержкой If-None-Match"""
+    return await dialogs_response(request, account, limit, include_folders, include_preview)
+
+
+@app.get("/dialogs/stream")
+async def stream_dialogs(account: str, limit: Optional[int] = None, include_folders: bool = True,
+                         include_preview: bool = False):
+    """
+    Диалоги в формате NDJSON: одна строка — один DialogInfo, по мере получения
+    страниц iter_dialogs, без сборки всего списка в памяти. Последняя строка —
+    итог {"status": "success", "total_dialogs": n} или {"status": "error", ...},
+    по ней клиент отличает полный ответ от оборванного.
+    """
+    client = get_client(account)
+    # Слот держится всё время выгрузки и освобождается по её окончании
+    release_admission = await hold_admission(account, "dialogs_stream")
+
+    async def stream():
+        total = 0
+        try:
+            dialog_to_folders = {}
+            if include_folders:
+                try:
+                    dialog_filters_result = await fetch_dialog_filters(account, client)
+                    dialog_to_folders = build_folder_index(getattr(dialog_filters_result, 'filters', []))
+                except Exception as e:
+                    log_dialogs.warning("Ошибка получения папок: %s", e)
+
+            async for dialog in client.iter_dialogs(limit=limit):
+                info = jsonable_encoder(dialog_to_info(dialog, dialog_to_folders, include_preview))
+                total += 1
+                yield json.dumps(info, ensure_ascii=False) + "\n"
+            yield json.dumps({"status": "success", "account": account, "total_dialogs": total}) + "\n"
+        except Exception as e:
+            log_dialogs.warning("Поток диалогов прерван: %s", e, extra={"account": account, "sent": total})
+            yield json.dumps({"status": "error", "detail": str(e), "total_dialogs": total}, ensure_ascii=False) + "\n"
+        finally:
+            await release_admission()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson", headers={"Cache-Control": "no-cache"},
+                             background=BackgroundTask(release_admission))
+
+
+async def folders_response(request: Request, account: str) -> Response:
+    client = get_client(account)
+
+    async def build():
+        dialog_filters_result = await fetch_dialog_filters(account, client)
         dialog_filters = getattr(dialog_filters_result, 'filters', [])
         folders = []
         
@@ -1122,35 +3141,33 @@ async def get_all_folders(account: str):
             "total_folders": len(folders),
             "folders": folders
         }
+
+    try:
+        return await conditional_json(request, (account, "folders"), get_version(account, "folders"), build)
     except Exception as e:
         raise HTTPException(500, detail=f"Ошибка получения папок: {str(e)}")
 
 
+@app.post("/folders/{account}")
+@admission_controlled("folders")
+async def get_all_folders(account: str, request: Request):
+    return await folders_response(request, account)
+
+
+@app.get("/folders/{account}")
+@admission_controlled("folders")
+async def get_all_folders_conditional(account: str, request: Request):
+    """GET-вариант /folders/{account} с поддержкой If-None-Match"""
+    return await folders_response(request, account)
+
+
 @app.post("/chat_history")
+@admission_controlled("chat_history")
 async def get_chat_history(req: GetChatHistoryReq):
-    client = ACTIVE_CLIENTS.get(req.account)
-    if not client:
-        raise HTTPException(400, detail=f"Аккаунт не найден: {req.account}")
+    client = get_client(req.account)
 
     try:
-        chat_id = req.chat_id
-        
-        if isinstance(chat_id, str):
-            if chat_id.startswith('@'):
-                chat_id = chat_id[1:]
-            if chat_id.lstrip('-').isdigit():
-                chat_id = int(chat_id)
-        
-        try:
-            chat = await client.get_entity(chat_id)
-        except Exception:
-            dialogs = await client.get_dialogs()
-            for dialog in dialogs:
-                if str(dialog.id) == str(chat_id) or (hasattr(dialog.entity, 'username') and dialog.entity.username == chat_id):
-                    chat = dialog.entity
-                    break
-            else:
-                raise HTTPException(400, detail=f"Не удалось найти чат: {req.chat_id}")
+        chat = await resolve_chat(req.account, client, req.chat_id)
         
         messages = await client.get_messages(
             chat,
@@ -1158,42 +3175,13 @@ async def get_chat_history(req: GetChatHistoryReq):
             offset_id=req.offset_id if req.offset_id and req.offset_id > 0 else None
         )
         
-        message_list = []
-        for msg in messages:
-            if msg is None:
-                continue
-                
-            text = ""
-            if hasattr(msg, 'text') and msg.text:
-                text = msg.text
-            elif hasattr(msg, 'message') and msg.message:
-                text = msg.message
-            
-            if not text and not hasattr(msg, 'media'):
-                continue
-            
-            message = ChatMessage(
-                id=msg.id,
-                date=msg.date.isoformat() if msg.date else "",
-                from_id=None,
-                text=text,
-                is_outgoing=msg.out if hasattr(msg, 'out') else False
-            )
-            message_list.append(message)
-        
-        chat_title = "Unknown"
-        if hasattr(chat, 'title'):
-            chat_title = chat.title
-        elif hasattr(chat, 'first_name'):
-            chat_title = chat.first_name
-            if hasattr(chat, 'last_name') and chat.last_name:
-                chat_title += f" {chat.last_name}"
+        message_list = [m for m in map(build_chat_message, messages) if m is not None]
         
         return {
             "status": "success",
             "account": req.account,
             "chat_id": req.chat_id,
-            "chat_title": chat_title,
+            "chat_title": chat_display_title(chat),
             "total_messages": len(message_list),
             "messages": message_list
         }
@@ -1203,6 +3191,1108 @@ async def get_chat_history(req: GetChatHistoryReq):
         raise HTTPException(500, detail=f"Ошибка получения истории: {str(e)}")
 
 
+async def fetch_latest_messages(account: str, client: TelegramClient, chat_id: Union[str, int], limit: int) -> dict:
+    chat = await resolve_chat(account, client, chat_id)
+    cached = TOP_MESSAGES.get(account, {}).get(utils.get_peer_id(chat)) if limit == 1 else None
+    if cached is not None:
+        # Последнее сообщение уже пришло с GetDialogs и с тех пор не менялось
+        messages, source = [cached], "dialogs"
+    else:
+        messages, source = await client.get_messages(chat, limit=limit), "history"
+    message_list = [m for m in map(build_chat_message, messages) if m is not None]
+    return {
+        "chat_id": chat_id,
+        "chat_title": chat_display_title(chat),
+        "source": source,
+        "total_messages": len(message_list),
+        "messages": message_list
+    }
+
+
+@app.post("/chat_history_batch")
+@admission_controlled("chat_history_batch")
+async def get_chat_history_batch(req: GetChatHistoryBatchReq):
+    """
+    Последние limit сообщений по нескольким чатам одним запросом, не больше
+    HISTORY_BATCH_CONCURRENCY чатов одновременно. При limit=1 сообщения берутся
+    из последних GetDialogs без запросов истории. Ошибка одного чата не
+    прерывает остальные: она попадает в errors.
+    """
+    client = get_client(req.account)
+    if not req.chat_ids:
+        raise HTTPException(400, detail="Список chat_ids пуст")
+    if len(req.chat_ids) > HISTORY_BATCH_MAX_CHATS:
+        raise HTTPException(400, detail=f"Не больше {HISTORY_BATCH_MAX_CHATS} чатов за запрос")
+    if not 1 <= req.limit <= 100:
+        raise HTTPException(400, detail="limit должен быть от 1 до 100")
+
+    semaphore = asyncio.Semaphore(HISTORY_BATCH_CONCURRENCY)
+
+    async def fetch(chat_id):
+        async with semaphore:
+            try:
+                return await fetch_latest_messages(req.account, client, chat_id, req.limit), None
+            except HTTPException as e:
+                return None, {"chat_id": chat_id, "error": e.detail}
+            except Exception as e:
+                return None, {"chat_id": chat_id, "error": str(e)}
+
+    results = await asyncio.gather(*(fetch(chat_id) for chat_id in dict.fromkeys(req.chat_ids)))
+    chats = [chat for chat, _ in results if chat is not None]
+    return {
+        "status": "success",
+        "account": req.account,
+        "total_chats": len(chats),
+        "from_dialogs_cache": sum(1 for chat in chats if chat["source"] == "dialogs"),
+        "chats": chats,
+        "errors": [error for _, error in results if error is not None]
+    }
+
+
+# ==================== Бинарный RPC: msgpack поверх WebSocket ====================
+# op → (модель запроса, эндпоинт). Эндпоинты вызываются напрямую, с тем же контролем нагрузки
+RPC_OPS = {
+    "send": (SendMessageReq, send_message),
+    "chat_history": (GetChatHistoryReq, get_chat_history),
+    "chat_history_batch": (GetChatHistoryBatchReq, get_chat_history_batch),
+    "get_sender_info": (GetSenderInfoReq, get_sender_info),
+    "get_sender_info_batch": (GetSenderInfoBatchReq, get_sender_info_batch),
+}
+
+
+async def rpc_call(op: str, args) -> dict:
+    spec = RPC_OPS.get(op)
+    if spec is None:
+        raise HTTPException(404, detail=f"Неизвестная операция '{op}'")
+    if not isinstance(args, dict):
+        raise HTTPException(422, detail="args должен быть словарём")
+    model, endpoint = spec
+    try:
+        req = model(**args)
+    except ValidationError as e:
+        raise HTTPException(422, detail=str(e))
+    return jsonable_encoder(await endpoint(req=req))
+
+
+@app.websocket("/rpc/ws")
+async def rpc_websocket(websocket: WebSocket):
+    """
+    Бинарный протокол для внутренних сервисов: кадры msgpack {"id", "op", "args"}
+    по одному постоянному соединению. Запросы выполняются конвейером, ответы
+    {"id", "result"} или {"id", "error": {"status", "detail"}} приходят по мере
+    готовности, не обязательно по порядку. Операции: см. RPC_OPS.
+    """
+    if msgpack is None:
+        await websocket.close(code=1011, reason="msgpack не установлен")
+        return
+
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+    in_flight = asyncio.Semaphore(RPC_MAX_IN_FLIGHT)
+    tasks = set()
+
+    async def reply(frame: dict):
+        data = msgpack.packb(frame, use_bin_type=True)
+        async with send_lock:
+            await websocket.send_bytes(data)
+
+    async def handle(request_id, op, args):
+        try:
+            try:
+                frame = {"id": request_id, "result": await rpc_call(op, args)}
+            except HTTPException as e:
+                frame = {"id": request_id, "error": {"status": e.status_code, "detail": e.detail}}
+            except Exception as e:
+                log_rpc.warning("Ошибка RPC %s: %s", op, e)
+                frame = {"id": request_id, "error": {"status": 500, "detail": str(e)}}
+            await reply(frame)
+        except (WebSocketDisconnect, RuntimeError):
+            pass  # Клиент отключился, ответ некуда отправить
+        finally:
+            in_flight.release()
+            DRAIN_STATE["in_flight"] -= 1
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            data = message.get("bytes")
+            if data is None:
+                await reply({"id": None, "error": {"status": 400, "detail": "Ожидается бинарный кадр msgpack"}})
+                continue
+            try:
+                frame = msgpack.unpackb(data, raw=False)
+                request_id, op, args = frame["id"], frame["op"], frame.get("args") or {}
+            except Exception:
+                await reply({"id": None, "error": {"status": 400, "detail": "Некорректный кадр"}})
+                continue
+            # Не читаем новые кадры, пока занято RPC_MAX_IN_FLIGHT слотов
+            await in_flight.acquire()
+            # Учитываем как HTTP-запрос: /admin/drain и остановка ждут начатых RPC
+            DRAIN_STATE["in_flight"] += 1
+            task = asyncio.create_task(handle(request_id, op, args))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Начатые операции (например, отправка сообщения) доводим до конца
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# ==================== Журнал изменений диалогов ====================
+def changed_dialog_peer(update) -> Optional[int]:
+    """Marked ID диалога, который меняет обновление (непрочитанные, последнее сообщение), или None"""
+    peer = None
+    if isinstance(update, (types.UpdateNewMessage, types.UpdateNewChannelMessage,
+                           types.UpdateEditMessage, types.UpdateEditChannelMessage)):
+        peer = getattr(update.message, 'peer_id', None)
+    elif isinstance(update, (types.UpdateReadHistoryInbox, types.UpdateReadHistoryOutbox)):
+        peer = update.peer
+    elif isinstance(update, (types.UpdateDialogUnreadMark, types.UpdateDialogPinned)):
+        peer = getattr(update.peer, 'peer', None)
+    elif isinstance(update, (types.UpdateReadChannelInbox, types.UpdateReadChannelOutbox,
+                             types.UpdateDeleteChannelMessages, types.UpdateChannel)):
+        peer = PeerChannel(update.channel_id)
+    elif isinstance(update, types.UpdateShortMessage):
+        peer = PeerUser(update.user_id)
+    elif isinstance(update, types.UpdateShortChatMessage):
+        peer = PeerChat(update.chat_id)
+    if peer is None:
+        return None
+    return utils.get_peer_id(peer)
+
+
+def dialog_change_log(account: str) -> dict:
+    log = DIALOG_CHANGES.get(account)
+    if log is None:
+        # epoch отличает журналы разных запусков: токен прошлого процесса требует полной синхронизации
+        log = {"epoch": uuid.uuid4().hex[:8], "seq": 0, "floor": 0, "log": deque()}
+        DIALOG_CHANGES[account] = log
+    return log
+
+
+def record_dialog_change(account: str, peer_id: int):
+    log = dialog_change_log(account)
+    log["seq"] += 1
+    log["log"].append((log["seq"], peer_id))
+    if len(log["log"]) > DIALOG_CHANGE_LOG_SIZE:
+        # floor — последний вытесненный seq: токены старше него уже не восстановить
+        log["floor"] = log["log"].popleft()[0]
+
+
+def dialog_change_token(log: dict) -> str:
+    return f"{log['epoch']}.{log['seq']}"
+
+
+async def fetch_peer_dialogs(client: TelegramClient, peer_ids: List[int]):
+    """
+    Текущее состояние указанных диалогов через GetPeerDialogsRequest (до 100 за запрос).
+    Возвращает (список Dialog, ID, которые не удалось разрешить).
+    Каналы, к которым больше нет доступа, в результат не попадают (для вызывающего — удалённые).
+    """
+    input_peers, unresolved = [], []
+    for peer_id in peer_ids:
+        try:
+            input_peers.append((peer_id, types.InputDialogPeer(await client.get_input_entity(peer_id))))
+        except (ValueError, TypeError):
+            unresolved.append(peer_id)
+
+    async def load(peers: list) -> list:
+        result = await client(functions.messages.GetPeerDialogsRequest(peers=peers))
+        entities = {utils.get_peer_id(e): e for e in [*result.users, *result.chats]}
+        messages = {}
+        for message in result.messages:
+            # Как в iter_dialogs Telethon: привязываем клиента и сущности к сообщению
+            # (_finish_init — приватный API Telethon 1.x)
+            message._finish_init(client, entities, None)
+            messages[(utils.get_peer_id(message.peer_id), message.id)] = message
+        loaded = []
+        for raw_dialog in result.dialogs:
+            if not isinstance(raw_dialog, types.Dialog):
+                continue
+            peer_id = utils.get_peer_id(raw_dialog.peer)
+            loaded.append(Dialog(client, raw_dialog, entities, messages.get((peer_id, raw_dialog.top_message))))
+        return loaded
+
+    dialogs = []
+    for start in range(0, len(input_peers), 100):
+        batch = input_peers[start:start + 100]
+        try:
+            dialogs.extend(await load([peer for _, peer in batch]))
+            continue
+        except FloodWaitError:
+            raise
+        except RPCError as e:
+            # Один недоступный канал (CHANNEL_PRIVATE и т.п.) роняет весь пакет — повторяем по одному
+            log_dialogs.info("Пакет GetPeerDialogs отклонён (%s), запрашиваем диалоги по одному", e)
+
+        for peer_id, peer in batch:
+            try:
+                dialogs.extend(await load([peer]))
+            except (ChannelPrivateError, ChannelInvalidError):
+                pass  # Нас исключили или канал удалён — диалога больше нет
+            except FloodWaitError:
+                raise
+            except RPCError as e:
+                log_dialogs.warning("Не удалось получить диалог %s: %s", peer_id, e)
+                unresolved.append(peer_id)
+    return dialogs, unresolved
+
+
+@app.get("/dialogs/changes")
+@admission_controlled("dialogs_changes")
+async def get_dialog_changes(account: str, since: Optional[str] = None, include_folders: bool = True,
+                             include_preview: bool = False):
+    """
+    Диалоги, изменившиеся после токена since, и новый токен.
+    full_resync=true означает, что токен устарел (или от прошлого запуска) —
+    нужно один раз забрать полный /dialogs и продолжить с выданного токена.
+    """
+    client = get_client(account)
+
+    log = dialog_change_log(account)
+    # Токен фиксируем до загрузки: изменения во время запроса придут в следующий раз
+    token = dialog_change_token(log)
+
+    since_seq = None
+    if since:
+        epoch, _, seq = since.partition(".")
+        if epoch == log["epoch"] and seq.isdigit():
+            since_seq = int(seq)
+    if since_seq is None or since_seq < log["floor"] or since_seq > log["seq"]:
+        return {"status": "success", "account": account, "token": token, "full_resync": True, "dialogs": [], "removed": []}
+
+    changed = list(dict.fromkeys(peer_id for seq, peer_id in log["log"] if seq > since_seq))
+    if not changed:
+        return {"status": "success", "account": account, "token": token, "full_resync": False, "dialogs": [], "removed": []}
+
+    try:
+        dialogs, unresolved = await fetch_peer_dialogs(client, changed)
+        dialog_to_folders = {}
+        if include_folders:
+            try:
+                dialog_to_folders = build_folder_index(getattr(await fetch_dialog_filters(account, client), 'filters', []))
+            except Exception as e:
+                log_dialogs.warning("Ошибка получения папок: %s", e)
+        dialog_list = await dialogs_to_info(dialogs, dialog_to_folders, include_preview)
+    except Exception as e:
+        raise HTTPException(500, detail=f"Ошибка получения изменений диалогов: {str(e)}")
+
+    returned = {dialog.id for dialog in dialogs}
+    removed = [utils.resolve_id(peer_id)[0] for peer_id in changed if peer_id not in returned and peer_id not in unresolved]
+    return {
+        "status": "success",
+        "account": account,
+        "token": token,
+        "full_resync": False,
+        "dialogs": dialog_list,
+        "removed": removed,
+        "unresolved": [utils.resolve_id(peer_id)[0] for peer_id in unresolved]
+    }
+
+
+# ==================== Сводные запросы по всем аккаунтам ====================
+async def fan_out_accounts(fetch, route: str):
+    """
+    Вызвать fetch(name, client) для всех аккаунтов параллельно (не больше
+    AGGREGATE_CONCURRENCY одновременно, не дольше AGGREGATE_TIMEOUT на аккаунт).
+    Каждый вызов проходит admit(name, route), как одиночный запрос к аккаунту:
+    отказ по лимиту становится ошибкой этого аккаунта.
+    Возвращает (результаты по аккаунтам, ошибки) — ответ частичный, если кто-то не успел.
+    """
+    semaphore = asyncio.Semaphore(AGGREGATE_CONCURRENCY)
+
+    async def admitted(name: str, client: TelegramClient):
+        async with admit(name, route):
+            return await fetch(name, client)
+
+    async def run(name: str, client: TelegramClient):
+        async with semaphore:
+            return await asyncio.wait_for(admitted(name, client), timeout=AGGREGATE_TIMEOUT)
+
+    accounts = list(ACTIVE_CLIENTS.items())
+    outcomes = await asyncio.gather(*(run(name, client) for name, client in accounts), return_exceptions=True)
+
+    results, errors = {}, []
+    for (name, _), outcome in zip(accounts, outcomes):
+        if isinstance(outcome, asyncio.TimeoutError):
+            errors.append({"account": name, "error": f"Таймаут {AGGREGATE_TIMEOUT} с"})
+        elif isinstance(outcome, HTTPException):
+            errors.append({"account": name, "error": outcome.detail, "status_code": outcome.status_code})
+        elif isinstance(outcome, Exception):
+            errors.append({"account": name, "error": str(outcome)})
+        else:
+            results[name] = outcome
+    return results, errors
+
+
+def merge_dialogs(results: Dict[str, List[DialogInfo]], only_unread: bool = False) -> List[dict]:
+    """Объединить диалоги аккаунтов, свежие сверху"""
+    merged = []
+    for name, dialog_list in results.items():
+        for dialog in dialog_list:
+            if only_unread and not dialog.unread_count:
+                continue
+            item = jsonable_encoder(dialog)
+            item["account"] = name
+            merged.append(item)
+    merged.sort(key=lambda d: d["last_message_date"] or "", reverse=True)
+    return merged
+
+
+@app.get("/all/dialogs")
+async def all_dialogs(limit: int = 50, include_folders: bool = False, include_preview: bool = False):
+    """Единый список диалогов всех аккаунтов, отсортированный по last_message_date"""
+    results, errors = await fan_out_accounts(
+        lambda name, client: load_dialog_infos(name, client, limit, include_folders, include_preview), "dialogs"
+    )
+    dialogs = merge_dialogs(results)
+    return {
+        "status": "partial" if errors else "success",
+        "accounts_ok": sorted(results),
+        "errors": errors,
+        "total_dialogs": len(dialogs),
+        "dialogs": dialogs
+    }
+
+
+@app.get("/all/unread")
+async def all_unread(limit: int = 100, include_folders: bool = False):
+    """Непрочитанные диалоги всех аккаунтов и итоги по каждому аккаунту"""
+    results, errors = await fan_out_accounts(
+        lambda name, client: load_dialog_infos(name, client, limit, include_folders), "dialogs"
+    )
+    dialogs = merge_dialogs(results, only_unread=True)
+    totals = {
+        name: {
+            "unread_dialogs": sum(1 for d in dialog_list if d.unread_count),
+            "unread_messages": sum(d.unread_count for d in dialog_list)
+        }
+        for name, dialog_list in results.items()
+    }
+    return {
+        "status": "partial" if errors else "success",
+        "accounts": totals,
+        "errors": errors,
+        "total_unread_dialogs": len(dialogs),
+        "total_unread_messages": sum(d["unread_count"] for d in dialogs),
+        "dialogs": dialogs
+    }
+
+
+# ==================== Соединения с другими DC и загрузка медиа ====================
+def dc_pool_supported(client: TelegramClient) -> bool:
+    # Закрытый API Telethon: экспорт авторизации в другой DC и общий пул таких соединений
+    return hasattr(client, '_borrow_exported_sender') and hasattr(client, '_return_exported_sender')
+
+
+def note_dc_use(account: str, client: TelegramClient, dc_id: int) -> str:
+    """
+    Учесть обращение к DC: "home" — домашний DC аккаунта, "hit" — соединение
+    уже удерживается, "miss" — Telethon будет экспортировать авторизацию.
+    Часто используемые DC ставятся на удержание в фоне.
+    """
+    if dc_id == client.session.dc_id:
+        DC_POOL_STATS["home"] += 1
+        return "home"
+    usage = DC_USAGE.setdefault(account, {})
+    usage[dc_id] = usage.get(dc_id, 0) + 1
+
+    pool = DC_POOL.setdefault(account, {})
+    entry = pool.get(dc_id)
+    if entry is not None and entry["sender"] is not None:
+        DC_POOL_STATS["hits"] += 1
+        entry["last_used"] = time.monotonic()
+        entry["uses"] += 1
+        return "hit"
+
+    DC_POOL_STATS["misses"] += 1
+    if entry is None and usage[dc_id] >= DC_POOL_MIN_USES and dc_pool_supported(client):
+        task = asyncio.create_task(warm_dc(account, client, dc_id))
+        DC_WARM_TASKS.add(task)
+        task.add_done_callback(DC_WARM_TASKS.discard)
+    return "miss"
+
+
+async def release_dc(account: str, client: TelegramClient, dc_id: int):
+    """Отпустить соединение: Telethon сам закроет его после своего таймаута простоя"""
+    entry = DC_POOL.get(account, {}).pop(dc_id, None)
+    if entry is None or entry["sender"] is None:
+        return
+    try:
+        await client._return_exported_sender(entry["sender"])
+    except Exception as e:
+        log_media.warning("Ошибка возврата соединения DC %s: %s", dc_id, e, extra={"account": account})
+
+
+async def warm_dc(account: str, client: TelegramClient, dc_id: int):
+    """Удерживать соединение с DC: заём у Telethon не даёт ему закрыть соединение по простою"""
+    pool = DC_POOL.setdefault(account, {})
+    if dc_id in pool:
+        return
+    coldest = None
+    if len(pool) >= DC_POOL_MAX_PER_ACCOUNT:
+        # Вытесняем наименее используемый готовый DC, если новый нужнее
+        usage = DC_USAGE.get(account, {})
+        ready = [d for d, entry in pool.items() if entry["sender"] is not None]
+        coldest = min(ready, key=lambda d: usage.get(d, 0), default=None)
+        if coldest is None or usage.get(coldest, 0) >= usage.get(dc_id, 0):
+            return
+
+    # Запись-заглушка до await: повторный вызов для этого DC не начнёт второе подключение
+    entry = pool[dc_id] = {"sender": None, "last_used": time.monotonic(), "uses": 0, "since": None}
+    if coldest is not None:
+        DC_POOL_STATS["evicted"] += 1
+        await release_dc(account, client, coldest)
+    try:
+        sender = await client._borrow_exported_sender(dc_id)
+    except Exception as e:
+        if pool.get(dc_id) is entry:
+            del pool[dc_id]
+        DC_POOL_STATS["warm_errors"] += 1
+        log_media.warning("Не удалось подготовить соединение с DC %s: %s", dc_id, e, extra={"account": account})
+        return
+    if pool.get(dc_id) is not entry or DC_POOL.get(account) is not pool or ACTIVE_CLIENTS.get(account) is not client:
+        # Пока шло подключение, запись вытеснили или аккаунт удалили
+        await client._return_exported_sender(sender)
+        return
+    entry["sender"] = sender
+    entry["since"] = datetime.now().isoformat()
+    DC_POOL_STATS["warmed"] += 1
+    log_media.info("Соединение с DC удерживается", extra={"account": account, "dc_id": dc_id})
+
+
+async def dc_pool_sweeper():
+    """Отпускать соединения, простаивающие дольше DC_POOL_IDLE_SECONDS"""
+    while True:
+        await asyncio.sleep(DC_POOL_SWEEP_INTERVAL)
+        now = time.monotonic()
+        for account, pool in list(DC_POOL.items()):
+            client = ACTIVE_CLIENTS.get(account)
+            if client is None:
+                continue
+            for dc_id, entry in list(pool.items()):
+                if entry["sender"] is not None and now - entry["last_used"] > DC_POOL_IDLE_SECONDS:
+                    DC_POOL_STATS["evicted"] += 1
+                    await release_dc(account, client, dc_id)
+
+
+@app.get("/media/download")
+async def download_media(account: str, chat_id: str, message_id: int):
+    """
+    Скачать файл из сообщения потоком. Заголовки X-DC-Id и X-DC-Pool
+    показывают DC файла и было ли соединение с ним уже готово (home/hit/miss).
+    """
+    client = get_client(account)
+    chat = await resolve_chat(account, client, chat_id)
+    message = await client.get_messages(chat, ids=message_id)
+    if message is None or not message.media:
+        raise HTTPException(404, detail="Сообщение с файлом не найдено")
+    try:
+        dc_id, _ = utils.get_input_location(message.media)
+    except TypeError:
+        raise HTTPException(400, detail="В сообщении нет файла для загрузки")
+
+    pool_state = note_dc_use(account, client, dc_id)
+    file = message.file
+    file_name = file.name or f"{message_id}{file.ext or ''}"
+    headers = {
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(file_name)}",
+        "X-DC-Id": str(dc_id),
+        "X-DC-Pool": pool_state
+    }
+    if message.document is not None and file.size:
+        headers["Content-Length"] = str(file.size)
+
+    # Слот держится всё время загрузки
+    release_admission = await hold_admission(account, "media_download")
+
+    async def stream():
+        try:
+            async for chunk in client.iter_download(message.media):
+                yield chunk
+        finally:
+            entry = DC_POOL.get(account, {}).get(dc_id)
+            if entry is not None:
+                entry["last_used"] = time.monotonic()
+            await release_admission()
+
+    return StreamingResponse(stream(), media_type=file.mime_type or "application/octet-stream", headers=headers,
+                             background=BackgroundTask(release_admission))
+
+
+@app.get("/metrics/dc_pool")
+def dc_pool_metrics():
+    """Доля загрузок, которым соединение с чужим DC уже было готово, и удерживаемые соединения"""
+    lookups = DC_POOL_STATS["hits"] + DC_POOL_STATS["misses"]
+    now = time.monotonic()
+    accounts = {}
+    for account in set(DC_USAGE) | set(DC_POOL):
+        client = ACTIVE_CLIENTS.get(account)
+        accounts[account] = {
+            "home_dc": client.session.dc_id if client else None,
+            "usage": DC_USAGE.get(account, {}),
+            "pooled": {
+                dc_id: {
+                    "ready": entry["sender"] is not None,
+                    "uses": entry["uses"],
+                    "idle_seconds": round(now - entry["last_used"], 1),
+                    "since": entry["since"]
+                }
+                for dc_id, entry in DC_POOL.get(account, {}).items()
+            }
+        }
+    return {
+        **DC_POOL_STATS,
+        "hit_rate": round(DC_POOL_STATS["hits"] / lookups, 3) if lookups else None,
+        "supported": all(dc_pool_supported(client) for client in ACTIVE_CLIENTS.values()),
+        "accounts": accounts
+    }
+
+
+# ==================== Фоновые задания: выгрузка участников и истории ====================
+JOB_TYPES = ("export_members", "chat_history", "archive")
+JOBS: Dict[str, dict] = {}
+JOB_TASKS: Dict[str, asyncio.Task] = {}
+JOB_SEMAPHORES: Dict[str, asyncio.Semaphore] = {}
+
+
+def job_meta_path(job_id: str) -> str:
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+def job_result_path(job_id: str) -> str:
+    return os.path.join(JOBS_DIR, f"{job_id}.ndjson.gz")
+
+
+async def acquire_job_lock(job_id: str) -> int:
+    """
+    Эксклюзивная блокировка файла задания. Во время передачи работы задание
+    может ещё выполняться в старом процессе — ждём, пока он его остановит.
+    """
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    fd = os.open(os.path.join(JOBS_DIR, f"{job_id}.lock"), os.O_CREAT | os.O_RDWR, 0o644)
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            try:
+                await asyncio.sleep(JOB_LOCK_RETRY_SECONDS)
+            except asyncio.CancelledError:
+                os.close(fd)
+                raise
+
+
+def release_job_lock(fd: int):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+def reload_job(job: dict):
+    """Перечитать задание с диска: другой процесс мог продвинуть контрольную точку"""
+    try:
+        with open(job_meta_path(job["id"]), "r", encoding="utf-8") as f:
+            job.update(json.load(f))
+    except FileNotFoundError:
+        pass
+
+
+def save_job(job: dict):
+    """Сохранить метаданные и контрольную точку задания (служебные ключи с '_' не сохраняются)"""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    tmp_path = f"{job_meta_path(job['id'])}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({k: v for k, v in job.items() if not k.startswith("_")}, f, ensure_ascii=False)
+    os.replace(tmp_path, job_meta_path(job["id"]))
+
+
+def load_jobs():
+    """Поднять задания с диска; прерванные рестартом снова ставятся в очередь"""
+    if not os.path.isdir(JOBS_DIR):
+        return
+    for file_name in os.listdir(JOBS_DIR):
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(JOBS_DIR, file_name), "r", encoding="utf-8") as f:
+                job = json.load(f)
+        except Exception as e:
+            log_jobs.error("Ошибка чтения задания %s: %s", file_name, e)
+            continue
+        if job["status"] == "running":
+            job["status"] = "queued"
+        JOBS[job["id"]] = job
+
+
+def job_view(job: dict) -> dict:
+    """Состояние задания для API: прогресс, скорость и оценка оставшегося времени"""
+    view = {k: v for k, v in job.items() if not k.startswith("_")}
+    rate = None
+    eta = None
+    if job["status"] == "running" and job.get("_run_started"):
+        elapsed = time.monotonic() - job["_run_started"]
+        done_this_run = job["items_done"] - job.get("_run_items_start", 0)
+        if elapsed > 0 and done_this_run > 0:
+            rate = done_this_run / elapsed
+            if job.get("total"):
+                eta = max(job["total"] - job["items_done"], 0) / rate
+    view["rate_per_second"] = round(rate, 2) if rate else None
+    view["eta_seconds"] = round(eta, 1) if eta is not None else None
+    if job["status"] == "completed":
+        if job["type"] == "archive":
+            view["result_url"] = f"/archive/{job['account']}/{job['checkpoint'].get('peer_id')}"
+        else:
+            view["result_url"] = f"/jobs/{job['id']}/result"
+    return view
+
+
+def append_job_result(job_id: str, records: list) -> int:
+    """Дописать порцию записей отдельным gzip-членом; вернуть новый размер файла"""
+    data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+    with open(job_result_path(job_id), "ab") as f:
+        f.write(gzip.compress(data))
+        return f.tell()
+
+
+def ensure_job_result(job_id: str):
+    """Задание без единой записи не создаёт файл — заводим пустой gzip, чтобы результат был всегда"""
+    if not os.path.exists(job_result_path(job_id)):
+        append_job_result(job_id, [])
+
+
+def read_job_ids(job_id: str) -> set:
+    ids = set()
+    with gzip.open(job_result_path(job_id), "rt", encoding="utf-8") as f:
+        for line in f:
+            ids.add(json.loads(line)["id"])
+    return ids
+
+
+async def write_job_batch(job: dict, records: list):
+    """Записать порцию и зафиксировать контрольную точку"""
+    loop = asyncio.get_running_loop()
+    job["result_bytes"] = await loop.run_in_executor(CPU_EXECUTOR, append_job_result, job["id"], records)
+    job["items_done"] += len(records)
+    save_job(job)
+
+
+def truncate_job_result(job: dict):
+    """Отрезать хвост, записанный после последней контрольной точки (рестарт посреди порции)"""
+    path = job_result_path(job["id"])
+    if os.path.exists(path):
+        with open(path, "r+b") as f:
+            f.truncate(job.get("result_bytes", 0))
+
+
+async def run_export_members_job(job: dict, client: TelegramClient):
+    group = await resolve_entity(job["account"], client, normalize_chat_id(job["params"]["group"]))
+    job["title"] = getattr(group, 'title', None)
+
+    # При продолжении пропускаем участников, уже записанных до рестарта
+    written_ids = set()
+    if job["items_done"]:
+        loop = asyncio.get_running_loop()
+        written_ids = await loop.run_in_executor(CPU_EXECUTOR, read_job_ids, job["id"])
+
+    batch = []
+    participants = client.iter_participants(group, aggressive=True)
+    async for participant in participants:
+        job["total"] = getattr(participants, 'total', None) or job.get("total")
+        if participant.id in written_ids:
+            continue
+        batch.append(participant)
+        if len(batch) >= JOB_BATCH_SIZE:
+            await write_job_batch(job, await map_in_executor(build_member_data, batch))
+            batch = []
+    if batch:
+        await write_job_batch(job, await map_in_executor(build_member_data, batch))
+
+
+async def run_chat_history_job(job: dict, client: TelegramClient):
+    params = job["params"]
+    chat = await resolve_chat(job["account"], client, params["chat_id"])
+    job["title"] = chat_display_title(chat)
+
+    if job.get("total") is None:
+        total = (await client.get_messages(chat, limit=0)).total
+        job["total"] = min(total, params["limit"]) if params.get("limit") else total
+
+    remaining = None
+    if params.get("limit"):
+        remaining = params["limit"] - job["checkpoint"].get("scanned", 0)
+        if remaining <= 0:
+            return
+
+    # История идёт от новых к старым, контрольная точка — ID самого старого записанного сообщения
+    batch = []
+    async for msg in client.iter_messages(chat, limit=remaining, offset_id=job["checkpoint"].get("offset_id", 0)):
+        message = build_chat_message(msg)
+        if message is not None:
+            batch.append(jsonable_encoder(message))
+        if len(batch) >= JOB_BATCH_SIZE:
+            job["checkpoint"]["offset_id"] = msg.id
+            job["checkpoint"]["scanned"] = job["checkpoint"].get("scanned", 0) + len(batch)
+            await write_job_batch(job, batch)
+            batch = []
+    if batch:
+        job["checkpoint"]["offset_id"] = batch[-1]["id"]
+        await write_job_batch(job, batch)
+
+
+ARCHIVE_EXTENSIONS = {"gzip": "ndjson.gz", "zstd": "ndjson.zst"}
+ARCHIVE_MEDIA_TYPES = {"gz": "application/gzip", "zst": "application/zstd"}
+
+
+def archive_dir(account: str, peer_id: int) -> str:
+    return os.path.join(ARCHIVE_DIR, account, str(peer_id))
+
+
+def archive_segment_name(state: dict) -> str:
+    return f"segment-{state['segment']:06d}.{ARCHIVE_EXTENSIONS[state['compression']]}"
+
+
+def load_archive_state(directory: str) -> Optional[dict]:
+    path = os.path.join(directory, "state.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_archive_state(directory: str, state: dict):
+    tmp_path = os.path.join(directory, f"state.json.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(directory, "state.json"))
+
+
+def write_archive_batch(path: str, compression: str, records: list, new_segment: bool = False) -> int:
+    """
+    Дописать порцию отдельным gzip-членом или zstd-кадром; вернуть новый размер сегмента.
+    Новый сегмент открывается с обрезкой: в нём не останется порции, записанной до сбоя.
+    """
+    data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+    compressed = zstandard.ZstdCompressor().compress(data) if compression == "zstd" else gzip.compress(data)
+    with open(path, "wb" if new_segment else "ab") as f:
+        f.write(compressed)
+        return f.tell()
+
+
+async def run_archive_job(job: dict, client: TelegramClient):
+    """
+    Архив истории чата: сообщения от старых к новым, начиная после
+    last_message_id предыдущего запуска, поэтому повторный запуск дописывает
+    только новые. Контрольная точка — state.json архива: после рестарта хвост
+    сегмента, записанный после неё, обрезается.
+    """
+    account = job["account"]
+    chat = await resolve_chat(account, client, job["params"]["chat_id"])
+    peer_id = utils.get_peer_id(chat)
+    job["title"] = chat_display_title(chat)
+    checkpoint = job["checkpoint"]
+    checkpoint["peer_id"] = peer_id
+
+    directory = archive_dir(account, peer_id)
+    os.makedirs(directory, exist_ok=True)
+    state = load_archive_state(directory) or {
+        "chat_id": peer_id,
+        "compression": ARCHIVE_COMPRESSION,
+        "last_message_id": 0,
+        "segment": 1,
+        "segment_bytes": 0,
+        "messages": 0,
+        "created_at": datetime.now().isoformat(),
+    }
+    state["title"] = job["title"]
+    checkpoint.setdefault("messages_at_start", state["messages"])
+    if state["compression"] == "zstd" and zstandard is None:
+        raise RuntimeError("Архив сжат zstd, для продолжения нужен пакет zstandard")
+
+    if job.get("total") is None:
+        # Оценка: удалённые сообщения не входят в total, но и не попадут в архив
+        total = (await client.get_messages(chat, limit=0)).total
+        job["total"] = max(total - state["messages"], 0)
+
+    segment_path = os.path.join(directory, archive_segment_name(state))
+    if os.path.exists(segment_path):
+        with open(segment_path, "r+b") as f:
+            f.truncate(state["segment_bytes"])
+    # Сегменты после контрольной точки: сбой между записью нового сегмента и state.json
+    for name in os.listdir(directory):
+        number = name.removeprefix("segment-").split(".", 1)[0]
+        if name.startswith("segment-") and number.isdigit() and int(number) > state["segment"]:
+            os.remove(os.path.join(directory, name))
+
+    loop = asyncio.get_running_loop()
+
+    async def commit(records: list, last_message_id: int):
+        if state["segment_bytes"] >= ARCHIVE_SEGMENT_BYTES:
+            state["segment"] += 1
+            state["segment_bytes"] = 0
+        if records:
+            path = os.path.join(directory, archive_segment_name(state))
+            state["segment_bytes"] = await loop.run_in_executor(
+                CPU_EXECUTOR, write_archive_batch, path, state["compression"], records, state["segment_bytes"] == 0
+            )
+        state["last_message_id"] = last_message_id
+        state["messages"] += len(records)
+        state["updated_at"] = datetime.now().isoformat()
+        save_archive_state(directory, state)
+        job["items_done"] = state["messages"] - checkpoint["messages_at_start"]
+        save_job(job)
+
+    batch = []
+    last_message_id = state["last_message_id"]
+    async for msg in client.iter_messages(chat, reverse=True, min_id=state["last_message_id"]):
+        message = build_chat_message(msg)
+        if message is not None:
+            batch.append(jsonable_encoder(message))
+        last_message_id = msg.id
+        if len(batch) >= JOB_BATCH_SIZE:
+            await commit(batch, last_message_id)
+            batch = []
+    if batch or last_message_id != state["last_message_id"]:
+        await commit(batch, last_message_id)
+
+
+JOB_RUNNERS = {
+    "export_members": run_export_members_job,
+    "chat_history": run_chat_history_job,
+    "archive": run_archive_job,
+}
+
+
+async def run_job(job_id: str):
+    job = JOBS[job_id]
+    semaphore = JOB_SEMAPHORES.setdefault(job["account"], asyncio.Semaphore(JOBS_PER_ACCOUNT))
+    async with semaphore:
+        if job["status"] == "cancelled":
+            return
+        client = ACTIVE_CLIENTS.get(job["account"])
+        if client is None:
+            # Аккаунт не подключен — задание продолжится из resume_jobs после /accounts/add
+            return
+
+        lock_fd = await acquire_job_lock(job_id)
+        try:
+            reload_job(job)
+            if job["status"] in ("completed", "failed", "cancelled"):
+                return
+
+            job["status"] = "running"
+            job["started_at"] = job.get("started_at") or datetime.now().isoformat()
+            job["_run_started"] = time.monotonic()
+            job["_run_items_start"] = job["items_done"]
+            truncate_job_result(job)
+            save_job(job)
+
+            try:
+                await JOB_RUNNERS[job["type"]](job, client)
+                if job["type"] != "archive":
+                    ensure_job_result(job_id)
+                job["status"] = "completed"
+                log_jobs.info("Задание выполнено", extra={"job_id": job_id, "items": job["items_done"]})
+            except asyncio.CancelledError:
+                # Отмена или остановка процесса: контрольная точка уже на диске
+                save_job(job)
+                raise
+            except Exception as e:
+                log_jobs.error("Ошибка задания: %s", e, extra={"job_id": job_id})
+                job["status"] = "failed"
+                job["error"] = str(e)
+            job["finished_at"] = datetime.now().isoformat()
+            save_job(job)
+        finally:
+            release_job_lock(lock_fd)
+
+
+def schedule_job(job_id: str):
+    task = JOB_TASKS.get(job_id)
+    if task and not task.done():
+        return
+    JOB_TASKS[job_id] = asyncio.create_task(run_job(job_id))
+
+
+def resume_jobs(account: str):
+    for job in list(JOBS.values()):
+        if job["account"] == account and job["status"] in ("queued", "running"):
+            schedule_job(job["id"])
+
+
+def create_job_record(account: str, job_type: str, params: dict) -> dict:
+    """Создать задание, сохранить его на диск и поставить в очередь"""
+    if DRAIN_STATE["handover"]:
+        raise HTTPException(503, detail="Процесс передаёт работу новому, повторите запрос",
+                            headers={"Retry-After": str(ADMISSION_RETRY_AFTER)})
+    job_id = uuid.uuid4().hex[:16]
+    job = {
+        "id": job_id,
+        "account": account,
+        "type": job_type,
+        "params": params,
+        "status": "queued",
+        "created_at": datetime.now().isoformat(),
+        "started_at": None,
+        "finished_at": None,
+        "items_done": 0,
+        "total": None,
+        "checkpoint": {},
+        "result_bytes": 0,
+        "error": None,
+    }
+    JOBS[job_id] = job
+    save_job(job)
+    schedule_job(job_id)
+    return job
+
+
+@app.post("/jobs")
+async def create_job(req: CreateJobReq):
+    """
+    Запустить долгую операцию в фоне: выгрузку участников (export_members),
+    истории чата (chat_history) или архива чата (archive, см. /archive).
+    Результат — NDJSON, сжатый gzip.
+    """
+    if req.account not in ACTIVE_CLIENTS:
+        raise HTTPException(400, detail=f"Аккаунт не найден: {req.account}")
+    if req.type not in JOB_TYPES:
+        raise HTTPException(400, detail=f"Неизвестный тип задания: {req.type}. Доступны: {', '.join(JOB_TYPES)}")
+    if req.type == "export_members" and req.group is None:
+        raise HTTPException(400, detail="Для export_members нужен параметр 'group'")
+    if req.type in ("chat_history", "archive") and req.chat_id is None:
+        raise HTTPException(400, detail=f"Для {req.type} нужен параметр 'chat_id'")
+
+    if req.type == "archive":
+        return await create_archive(ArchiveReq(account=req.account, chat_id=req.chat_id))
+    params = {"group": req.group} if req.type == "export_members" else {"chat_id": req.chat_id, "limit": req.limit}
+    return job_view(create_job_record(req.account, req.type, params))
+
+
+@app.get("/jobs")
+def list_jobs(account: Optional[str] = None):
+    jobs = [job_view(job) for job in JOBS.values() if account is None or job["account"] == account]
+    return {"total_jobs": len(jobs), "jobs": jobs}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = JOBS.get(job_id)
+    if not job:
+        raise HTTPException(404, detail="Задание не найдено")
+    return job_view(job)
+
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    job = JOBS.get(job_id)
+    if not job:
+        raise HTTPException(404, detail="Задание не найдено")
+    if job["status"] != "completed":
+        raise HTTPException(409, detail=f"Задание ещё не завершено: {job['status']}")
+    if job["type"] == "archive":
+        raise HTTPException(400, detail=f"Архив хранится сегментами: {job_view(job)['result_url']}")
+    # Задания, завершённые без записей до появления ensure_job_result
+    ensure_job_result(job_id)
+    return FileResponse(
+        job_result_path(job_id),
+        media_type="application/gzip",
+        filename=f"{job['type']}-{job_id}.ndjson.gz"
+    )
+
+
+@app.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    job = JOBS.get(job_id)
+    if not job:
+        raise HTTPException(404, detail="Задание не найдено")
+    if job["status"] in ("completed", "failed", "cancelled"):
+        return job_view(job)
+    job["status"] = "cancelled"
+    job["finished_at"] = datetime.now().isoformat()
+    task = JOB_TASKS.get(job_id)
+    if task:
+        task.cancel()
+    save_job(job)
+    return job_view(job)
+
+
+async def archive_peer_id(account: str, chat_id: Union[str, int]) -> int:
+    """Marked peer id чата — имя каталога архива; без подключённого аккаунта годится только числовой ID"""
+    client = ACTIVE_CLIENTS.get(account)
+    if client is not None:
+        return utils.get_peer_id(await resolve_chat(account, client, chat_id))
+    normalized = normalize_chat_id(chat_id)
+    if not isinstance(normalized, int):
+        raise HTTPException(400, detail=f"Аккаунт '{account}' не подключен: укажите числовой chat_id")
+    return normalized
+
+
+@app.post("/archive")
+async def create_archive(req: ArchiveReq):
+    """
+    Запустить (или продолжить) архивирование истории чата. Первый запуск
+    выгружает всю историю, следующие — только сообщения новее последнего
+    архивированного. Если архивирование этого чата уже идёт, возвращается
+    текущее задание.
+    """
+    client = get_client(req.account)
+    if ARCHIVE_COMPRESSION not in ARCHIVE_EXTENSIONS:
+        raise HTTPException(500, detail=f"Неизвестное сжатие ARCHIVE_COMPRESSION={ARCHIVE_COMPRESSION}")
+    if ARCHIVE_COMPRESSION == "zstd" and zstandard is None:
+        raise HTTPException(500, detail="Для ARCHIVE_COMPRESSION=zstd нужен пакет zstandard")
+
+    peer_id = utils.get_peer_id(await resolve_chat(req.account, client, req.chat_id))
+    for job in JOBS.values():
+        if (job["type"] == "archive" and job["account"] == req.account
+                and job["params"]["chat_id"] == peer_id and job["status"] in ("queued", "running")):
+            return job_view(job)
+    return job_view(create_job_record(req.account, "archive", {"chat_id": peer_id}))
+
+
+@app.get("/archive/{account}/{chat_id}")
+async def get_archive(account: str, chat_id: str):
+    """Состояние архива чата: последнее сообщение, число сообщений, сегменты и текущее задание"""
+    peer_id = await archive_peer_id(account, chat_id)
+    directory = archive_dir(account, peer_id)
+    state = load_archive_state(directory)
+    if state is None:
+        raise HTTPException(404, detail="Архив не найден")
+
+    segments = [
+        {
+            "name": name,
+            "bytes": os.path.getsize(os.path.join(directory, name)),
+            "url": f"/archive/{account}/{peer_id}/{name}"
+        }
+        for name in sorted(os.listdir(directory)) if name.startswith("segment-")
+    ]
+    active = [
+        job_view(job) for job in JOBS.values()
+        if job["type"] == "archive" and job["account"] == account and job["params"]["chat_id"] == peer_id
+        and job["status"] in ("queued", "running")
+    ]
+    return {**state, "segments": segments, "job": active[0] if active else None}
+
+
+@app.get("/archive/{account}/{chat_id}/{segment}")
+async def get_archive_segment(account: str, chat_id: str, segment: str):
+    """
+    Скачать сегмент архива. Последний сегмент может дописываться: безопасно
+    читать его до segment_bytes из состояния архива.
+    """
+    directory = archive_dir(account, await archive_peer_id(account, chat_id))
+    if not segment.startswith("segment-") or not os.path.isdir(directory) or segment not in os.listdir(directory):
+        raise HTTPException(404, detail="Сегмент не найден")
+    return FileResponse(
+        os.path.join(directory, segment),
+        media_type=ARCHIVE_MEDIA_TYPES[segment.rsplit(".", 1)[-1]],
+        filename=segment
+    )
+
+
 # ==================== Запуск ====================
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))